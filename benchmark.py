@@ -0,0 +1,328 @@
+# Нагрузочный стенд для main.py: заполняет отдельную базу синтетическими привычками
+# и логами, запускает планировщик, отправителя и хэндлеры против локальных заглушек
+# Bot API и Together.ai и печатает длительность тика, задержку доставки,
+# p50/p99 хэндлеров и память. Работает без сети:
+#
+#     python benchmark.py --users 10000
+#     python benchmark.py --users 100000 --due 0.05 | tee bench_output.txt
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import statistics
+import tempfile
+import time
+
+from aiohttp import web, ClientSession
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Заглушка Bot API: отвечает как Telegram и запоминает, когда пришло каждое sendMessage
+def fake_telegram_app() -> web.Application:
+    sent: list[tuple[int, float]] = []
+
+    async def handle_method(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(form.get("chat_id") or 0)
+            if method == "sendMessage":
+                sent.append((chat_id, time.time()))
+            result = {
+                "message_id": len(sent) + 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": form.get("text", "")
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response({"sent": sent})
+
+    async def handle_reset(request: web.Request) -> web.Response:
+        sent.clear()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_post("/reset", handle_reset)
+    return app
+
+
+# Заглушка Together.ai с настраиваемой задержкой, поддерживает n и stream
+def fake_llm_app(latency: float) -> web.Application:
+    async def handle_chat(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        usage = {"prompt_tokens": len(json.dumps(body["messages"])) // 4, "completion_tokens": 40}
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for word in ("Keep ", "going, ", "you ", "are ", "doing ", "great!"):
+                chunk = {"choices": [{"delta": {"content": word}}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        choices = [{"message": {"content": f"Benchmark motivation #{i}"}} for i in range(body.get("n", 1))]
+        return web.json_response({"choices": choices, "usage": usage})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handle_chat)
+    return app
+
+
+def run_fake_servers(telegram_port: int, llm_port: int, llm_latency: float):
+    async def serve():
+        for app, port in ((fake_telegram_app(), telegram_port), (fake_llm_app(llm_latency), llm_port)):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"Fake server on port {port} did not start")
+
+
+def percentile(values: list[float], q: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Синтетические пользователи: часовые пояса и минуты напоминаний равномерно
+# размазаны, у каждой привычки есть история логов за logs_days дней
+def seed_database(main, users: int, habits_per_user: int, logs_days: int):
+    zones = [*main.COMMON_TIMEZONES, None]
+    now = int(time.time())
+    today = main.day_number(main.datetime.now(main.UTC).date())
+    rng = random.Random(21)
+
+    def seed(conn):
+        habits = []
+        for index in range(users * habits_per_user):
+            user_id = 1_000_000 + index // habits_per_user
+            zone_name = zones[index % len(zones)]
+            offset = (index % 25) - 12
+            if zone_name is not None:
+                offset = main.utc_offset_hours(main.find_timezone(zone_name))
+            days = ",".join(day for day in main.WEEKDAYS if rng.random() < 0.7) or "Monday"
+            reminder_time = f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"
+            slot = main.HabitSlot.from_row(days, reminder_time, zone_name, offset)
+            habits.append((user_id, "health", f"Habit {index}", "Synthetic habit", "Do it daily", days, offset,
+                           reminder_time, 1, zone_name, main.next_fire_at(slot, now)))
+        conn.executemany("""
+            INSERT INTO habits (user_id, category, habit_name, habit_description, goal, days, timezone_offset,
+                                reminder_time, is_active, timezone_name, next_fire_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, habits)
+
+        statuses = ("done", "done", "done", "partial", "missed")
+        for habit_id, user_id in conn.execute("SELECT id, user_id FROM habits").fetchall():
+            conn.executemany(
+                "INSERT INTO habit_logs (habit_id, day, user_id, status) VALUES (?, ?, ?, ?)",
+                [(habit_id, day, user_id, rng.choice(statuses)) for day in range(today - logs_days, today)]
+            )
+        main.rebuild_habit_progress(conn)
+
+    return seed
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text
+        }
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "reminder"
+            }
+        }
+    }
+
+
+async def run_benchmark(args, telegram_port: int):
+    import main
+    from aiogram.types import Update
+
+    report = []
+    telegram_url = f"http://127.0.0.1:{telegram_port}"
+
+    started = time.perf_counter()
+    await main.db.transaction(seed_database(main, args.users, args.habits_per_user, args.logs_days))
+    habits = args.users * args.habits_per_user
+    report.append(f"Seeded {args.users} users, {habits} habits, {habits * args.logs_days} logs "
+                  f"in {time.perf_counter() - started:.1f}s")
+
+    # Тик: часть привычек срабатывает прямо сейчас, reminder_scheduler ставит их в outbox,
+    # outbox_sender доставляет в заглушку Bot API
+    step = max(1, round(1 / args.due))
+    fire_at = int(time.time())
+    await main.db.execute("UPDATE habits SET next_fire_at = ? WHERE id % ? = 0", (fire_at, step))
+    due = (await main.db.fetchone("SELECT COUNT(*) FROM habits WHERE next_fire_at = ?", (fire_at,)))[0]
+
+    async with ClientSession() as session:
+        await session.post(f"{telegram_url}/reset")
+        scheduler = asyncio.create_task(main.reminder_scheduler())
+        sender = asyncio.create_task(main.outbox_sender())
+
+        deadline = time.monotonic() + args.timeout
+        while not main.SCHEDULER_TICK.values and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        scheduler.cancel()
+        _, tick_seconds, _ = main.SCHEDULER_TICK.values.get((), (None, 0.0, 0))
+        report.append(f"Scheduler tick: {due} due reminders queued in {tick_seconds:.2f}s")
+
+        while time.monotonic() < deadline:
+            pending = (await main.db.fetchone("SELECT COUNT(*) FROM outbox WHERE status = 'pending'"))[0]
+            if not pending:
+                break
+            await asyncio.sleep(0.2)
+        sender.cancel()
+        await asyncio.gather(scheduler, sender, return_exceptions=True)
+
+        async with session.get(f"{telegram_url}/stats") as response:
+            sent = (await response.json())["sent"]
+        lags = [received - fire_at for _, received in sent]
+        report.append(f"Delivery: {len(sent)}/{due} reminders, lag p50 {percentile(lags, 50):.2f}s "
+                      f"p99 {percentile(lags, 99):.2f}s max {max(lags, default=0):.2f}s")
+
+    # Хэндлеры через dispatcher, как при настоящих апдейтах: middleware, FSM и БД
+    rng = random.Random(7)
+    user_ids = [1_000_000 + rng.randrange(args.users) for _ in range(args.requests)]
+    habit_ids = {user_id: habit_id for habit_id, user_id in await main.db.fetchall("SELECT id, user_id FROM habits")}
+    latencies: dict[str, list[float]] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request(update_id: int, user_id: int):
+        roll = rng.random()
+        if roll < 0.5:
+            kind, update = "progress", message_update(update_id, user_id, "📈 My Progress")
+        elif roll < 0.8:
+            kind, update = "done", callback_update(update_id, user_id, f"done:{habit_ids[user_id]}")
+        else:
+            kind, update = "motivation", message_update(update_id, user_id, "💪 Motivation")
+        async with semaphore:
+            started = time.perf_counter()
+            await main.dp.feed_update(main.bot, Update.model_validate(update))
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request(i + 1, user_id) for i, user_id in enumerate(user_ids)))
+    elapsed = time.perf_counter() - started
+    report.append(f"Handlers: {args.requests} updates in {elapsed:.2f}s ({args.requests / elapsed:.0f}/s), "
+                  f"concurrency {args.concurrency}")
+    for kind, values in sorted(latencies.items()):
+        report.append(f"  {kind:<10} n={len(values):<6} p50 {percentile(values, 50) * 1000:.1f}ms "
+                      f"p99 {percentile(values, 99) * 1000:.1f}ms")
+
+    report.append(f"Peak RSS: {rss_mb():.0f} MiB")
+
+    await main.fsm_storage.close()
+    await main.close_http_client()
+    await main.bot.session.close()
+    main.db.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the 21Day habit bot")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--habits-per-user", type=int, default=1)
+    parser.add_argument("--logs-days", type=int, default=10, help="days of synthetic history per habit")
+    parser.add_argument("--due", type=float, default=0.1, help="share of habits firing in the measured tick")
+    parser.add_argument("--requests", type=int, default=2000, help="handler updates to replay")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake Together.ai response time, seconds")
+    parser.add_argument("--telegram-rate", type=float, default=10000,
+                        help="global send rate; the real Bot API allows about 30/s")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--db", help="database file to create (default: a temporary directory)")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="habit-bench-"), "habits.db")
+    if os.path.exists(db_path):
+        parser.error(f"{db_path} already exists; the benchmark only seeds a new database")
+
+    telegram_port = free_port()
+    llm_port = free_port()
+    fakes = multiprocessing.get_context("fork").Process(
+        target=run_fake_servers, args=(telegram_port, llm_port, args.llm_latency), daemon=True
+    )
+    fakes.start()
+
+    # main.py читает настройки при импорте, поэтому окружение готовим заранее
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "DB_PATH": db_path,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "TOGETHER_API_URL": f"http://127.0.0.1:{llm_port}/v1/chat/completions",
+        "TOGETHER_API_KEY": "benchmark",
+        "TELEGRAM_GLOBAL_RATE": str(args.telegram_rate),
+        "MOTIVATION_CACHE_PERSIST": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+
+    async def run():
+        await wait_for_port(telegram_port)
+        await wait_for_port(llm_port)
+        return await run_benchmark(args, telegram_port)
+
+    try:
+        report = asyncio.run(run())
+    finally:
+        fakes.terminate()
+
+    print(f"Database: {db_path}")
+    print("\n".join(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,921 @@
 import os
-from aiogram import Bot, Dispatcher, types, F 
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.filters import Command
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, FSInputFile
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
+import argparse
 import asyncio
+import bisect
+import copy
+import csv
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import replace
 from datetime import datetime, timedelta, UTC, timezone, date
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import sqlite3
+import multiprocessing
+import random
+import socket
+import tempfile
+import threading
+import time
 import httpx
 
 
-conn = sqlite3.connect("habits.db")
-cursor = conn.cursor()
+load_dotenv()
+API_TOKEN = os.getenv("BOT_TOKEN")
+# Свой адрес Bot API: локальный telegram-bot-api сервер или заглушка для нагрузочных тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+TOGETHER_API_URL = os.getenv("TOGETHER_API_URL", "https://api.together.xyz/v1/chat/completions")
+TOGETHER_MODEL = os.getenv("TOGETHER_MODEL", "mistralai/Mistral-7B-Instruct-v0.2")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+# Потоковые ответы AI-ассистента и минимальный интервал между правками сообщения
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Память AI-чата: сколько последних реплик и токенов держим дословно, длина краткого содержания
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "12"))
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "800"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "150"))
+# Кэш мотивационных сообщений: размер, время жизни и число вариантов на ключ
+MOTIVATION_CACHE_SIZE = int(os.getenv("MOTIVATION_CACHE_SIZE", "5000"))
+MOTIVATION_CACHE_TTL = int(os.getenv("MOTIVATION_CACHE_TTL", str(12 * 3600)))
+MOTIVATION_VARIANTS = int(os.getenv("MOTIVATION_VARIANTS", "3"))
+MOTIVATION_CACHE_PERSIST = os.getenv("MOTIVATION_CACHE_PERSIST", "1") == "1"
+# Сколько запросов к LLM выполняется одновременно и сколько может ждать в очереди
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "50"))
+# Фоновый пул готовых мотиваций: вариантов на привычку, привычек за проход, пауза между проходами
+MOTIVATION_POOL_SIZE = int(os.getenv("MOTIVATION_POOL_SIZE", "3"))
+MOTIVATION_POOL_BATCH = int(os.getenv("MOTIVATION_POOL_BATCH", "20"))
+MOTIVATION_POOL_INTERVAL = int(os.getenv("MOTIVATION_POOL_INTERVAL", "300"))
+MOTIVATION_POOL_MAX_HABITS = int(os.getenv("MOTIVATION_POOL_MAX_HABITS", "10000"))
+# Логи и метрики: уровень логирования, адрес HTTP-эндпоинта /metrics (0 — выключен)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+DB_PATH = os.getenv("DB_PATH", "habits.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# FSM в SQLite: сколько секунд доверяем кэшу сессии, задержка пакетной записи, размер кэша
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "5"))
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "0.05"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Кэш привычек пользователя: сколько пользователей держим и сколько секунд доверяем записи
+USER_HABIT_CACHE_SIZE = int(os.getenv("USER_HABIT_CACHE_SIZE", "10000"))
+USER_HABIT_CACHE_TTL = float(os.getenv("USER_HABIT_CACHE_TTL", "60"))
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+REMINDER_WORKERS = int(os.getenv("REMINDER_WORKERS", "16"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "3"))
+# Сколько пропущенных минут планировщик догоняет после простоя
+MAX_CATCHUP_MINUTES = int(os.getenv("MAX_CATCHUP_MINUTES", "60"))
+# Сколько наступивших напоминаний планировщик выбирает за один запрос
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "500"))
+# Фоновые задачи выполняет только держатель аренды в scheduler_lock
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+LEADER_RENEW_INTERVAL = float(os.getenv("LEADER_RENEW_INTERVAL", "10"))
+# Очередь исходящих сообщений (outbox) и отправитель
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "120"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETENTION = int(os.getenv("OUTBOX_RETENTION", str(24 * 3600)))
+# Выгрузка и загрузка истории: строк за один fetchmany и записей на транзакцию импорта
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "1000"))
+# Как часто искать привычки, прошедшие 21 день
+COMPLETION_SWEEP_INTERVAL = float(os.getenv("COMPLETION_SWEEP_INTERVAL", "60"))
+# Запускать ли фоновые задачи (планировщик, отправитель, завершение привычек) в процессе бота
+RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "1") == "1"
+# Webhook-режим
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+# Построчные логи каждого запроса к LLM и каждого апдейта webhook — только при DEBUG
+for noisy_logger in ("httpx", "aiohttp.access"):
+    logging.getLogger(noisy_logger).setLevel(logging.DEBUG if LOG_LEVEL == "DEBUG" else logging.WARNING)
+bot_log = logging.getLogger("habit_bot")
+db_log = logging.getLogger("habit_bot.db")
+llm_log = logging.getLogger("habit_bot.llm")
+scheduler_log = logging.getLogger("habit_bot.scheduler")
+sender_log = logging.getLogger("habit_bot.sender")
+
+
+# Метрики в текстовом формате Prometheus. Обновляются и из event loop, и из
+# потоков БД, поэтому изменения идут под блокировкой.
+METRICS = []
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма, количество]
+        self.values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def timer(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    labels = format_labels((*self.labels, "le"), (*label_values, bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time spent in aiogram handlers", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by aiogram handlers", ("handler",))
+DB_QUERY_LATENCY = Histogram("db_query_seconds", "Database calls including the wait for a DB thread", ("op",))
+SCHEDULER_TICK = Histogram("scheduler_tick_seconds", "Duration of one reminder scheduler tick")
+LLM_LATENCY = Histogram("llm_request_seconds", "Together.ai request duration including retries", ("kind", "outcome"))
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by Together.ai", ("type",))
+TELEGRAM_SEND_ERRORS = Counter("telegram_send_errors_total", "Failed Telegram send attempts", ("error",))
+OUTBOX_MESSAGES = Counter("outbox_messages_total", "Outbox delivery results", ("result",))
+MOTIVATION_CACHE_LOOKUPS = Counter("motivation_cache_lookups_total", "Motivation cache lookups", ("result",))
+LLM_COALESCED = Counter("llm_requests_coalesced_total", "LLM requests that joined an identical request in flight")
+LLM_SHED = Counter("llm_requests_shed_total", "LLM requests rejected because the queue was full")
+
+
+# Асинхронный доступ к SQLite: запись идёт через один поток, чтение — через пул,
+# у каждого потока своё соединение. Event loop на запросах не блокируется.
+class Database:
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _submit(self, executor, fn, *args):
+        loop = asyncio.get_running_loop()
+        # Транзакции подписываем именем функции, остальное — именем метода
+        op = args[0].__name__ if fn in (self._transaction, self._read) else fn.__name__.lstrip("_")
+        with DB_QUERY_LATENCY.timer(op):
+            return await loop.run_in_executor(executor, fn, *args)
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _execute(self, sql, params):
+        conn = self._connection()
+        with conn:
+            return conn.execute(sql, params).lastrowid
+
+    def _transaction(self, fn, *args):
+        conn = self._connection()
+        with conn:
+            return fn(conn, *args)
+
+    # Чтение одним снимком: в WAL-режиме запись в это время не блокируется
+    def _read(self, fn, *args):
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            return fn(conn, *args)
+        finally:
+            conn.execute("ROLLBACK")
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self._submit(self._readers, self._fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await self._submit(self._readers, self._fetchall, sql, params)
+
+    # Один запрос на запись с коммитом, возвращает lastrowid
+    async def execute(self, sql: str, params: tuple = ()):
+        return await self._submit(self._writer, self._execute, sql, params)
+
+    # fn(conn, *args) выполняется в потоке записи внутри одной транзакции
+    async def transaction(self, fn, *args):
+        return await self._submit(self._writer, self._transaction, fn, *args)
+
+    # fn(conn, *args) выполняется в потоке чтения, для долгих выборок вроде выгрузки
+    async def read(self, fn, *args):
+        return await self._submit(self._readers, self._read, fn, *args)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+# Миграции схемы. Номер последней применённой хранится в PRAGMA user_version,
+# новые миграции добавляются только в конец списка MIGRATIONS.
+def migrate_base_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS habits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        habit_name TEXT NOT NULL,
+        habit_description TEXT NOT NULL,
+        goal TEXT NOT NULL,
+        days TEXT NOT NULL,
+        timezone_offset INTEGER NOT NULL,
+        reminder_time TEXT NOT NULL,
+        is_active INTEGER DEFAULT 1
+    )
+    """)
+
+    # Новая таблица habit_logs
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS habit_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        habit_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        status TEXT
+    )
+    """)
+
+
+# Сводный прогресс по привычке, обновляется вместе с habit_logs
+def migrate_habit_progress(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS habit_progress (
+        habit_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        partial INTEGER NOT NULL DEFAULT 0,
+        missed INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        last_log_date TEXT,
+        current_streak INTEGER NOT NULL DEFAULT 0
+    )
+    """)
 
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS habits (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    category TEXT NOT NULL,
-    habit_name TEXT NOT NULL,
-    habit_description TEXT NOT NULL,
-    goal TEXT NOT NULL,
-    days TEXT NOT NULL,
-    timezone_offset INTEGER NOT NULL,
-    reminder_time TEXT NOT NULL,
-    is_active INTEGER DEFAULT 1
-)
-""")
-conn.commit()
-
-# Новая таблица habit_logs
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS habit_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    habit_id INTEGER NOT NULL,
-    date TEXT NOT NULL,
-    status TEXT
-)
-""")
-conn.commit()
+# Индексы под все пути чтения и не больше одного лога на привычку в день
+def migrate_indexes(conn):
+    conn.execute("""
+        DELETE FROM habit_logs
+        WHERE id NOT IN (SELECT MIN(id) FROM habit_logs GROUP BY habit_id, date)
+    """)
 
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_habit_logs_habit_date ON habit_logs (habit_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habit_logs_user_habit_date ON habit_logs (user_id, habit_id, date, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_active ON habits (user_id, is_active)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habit_progress_user ON habit_progress (user_id)")
 
-load_dotenv()
-API_TOKEN = os.getenv("BOT_TOKEN")
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# Состояние планировщика (последняя обработанная минута и т.п.)
+def migrate_scheduler_state(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS scheduler_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+
+
+# Сохранённые варианты мотивации, чтобы кэш переживал рестарт
+def migrate_motivation_cache(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS motivation_cache (
+        cache_key TEXT NOT NULL,
+        message TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (cache_key, message)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_motivation_cache_created ON motivation_cache (created_at)")
+
+
+# Состояния FSM (мастер создания привычки и т.п.), переживают рестарт
+def migrate_fsm_storage(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        storage_key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at INTEGER NOT NULL
+    )
+    """)
+
 
+# Аренда лидера для фоновых задач и лента изменений привычек для индекса напоминаний
+def migrate_leader_and_changes(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS scheduler_lock (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS habit_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        habit_id INTEGER NOT NULL
+    )
+    """)
+
+
+# Надёжная очередь исходящих сообщений: планировщик пишет, отправитель читает
+def migrate_outbox(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        chat_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        last_error TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, next_attempt_at)")
+
+
+# Быстрый поиск привычек, набравших 21 день
+def migrate_progress_total_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habit_progress_total ON habit_progress (total) WHERE total >= 21")
+
+
+# Часовой пояс IANA и заранее посчитанное время следующего напоминания (UTC, секунды).
+# Для старых привычек next_fire_at заполнит планировщик при загрузке.
+def migrate_timezones(conn):
+    conn.execute("ALTER TABLE habits ADD COLUMN timezone_name TEXT")
+    conn.execute("ALTER TABLE habits ADD COLUMN next_fire_at INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_next_fire ON habits (next_fire_at) WHERE is_active = 1")
+
+
+# Логи по местному календарю привычки: номер дня от 1970-01-01 вместо строки даты
+# и составной первичный ключ (habit_id, day) без отдельного rowid.
+def migrate_local_days(conn):
+    conn.execute("""
+    CREATE TABLE habit_logs_new (
+        habit_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT,
+        PRIMARY KEY (habit_id, day)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO habit_logs_new (habit_id, day, user_id, status)
+        SELECT habit_id, CAST(julianday(date) - julianday('1970-01-01') AS INTEGER), user_id, status
+        FROM habit_logs ORDER BY id
+    """)
+    conn.execute("DROP TABLE habit_logs")
+    conn.execute("ALTER TABLE habit_logs_new RENAME TO habit_logs")
+
+    conn.execute("ALTER TABLE habit_progress ADD COLUMN last_log_day INTEGER")
+    conn.execute("ALTER TABLE habit_progress DROP COLUMN last_log_date")
+
+
+# Аналитика для экрана прогресса: самая длинная серия и выполнение по дням недели.
+# Обновляются вместе с habit_progress при каждой записи в журнал.
+def migrate_habit_analytics(conn):
+    conn.execute("ALTER TABLE habit_progress ADD COLUMN longest_streak INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS habit_weekday_stats (
+        habit_id INTEGER NOT NULL,
+        weekday INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (habit_id, weekday)
+    ) WITHOUT ROWID
+    """)
+    rebuild_habit_progress(conn)
+
+
+# Какая из привычек пользователя сейчас выбрана в меню
+def migrate_user_settings(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        selected_habit_id INTEGER
+    )
+    """)
+
+
+# Версия записи FSM для compare-and-set между процессами
+def migrate_fsm_versions(conn):
+    conn.execute("ALTER TABLE fsm_storage ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+# Кандидаты completion_sweeper — только ещё не обработанные завершения. Иначе
+# в индекс по total >= 21 попадали все когда-либо завершённые привычки, и
+# ежеминутный проход рос вместе с ними.
+def migrate_progress_swept(conn):
+    conn.execute("ALTER TABLE habit_progress ADD COLUMN swept INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        UPDATE habit_progress SET swept = 1
+        WHERE total >= 21 AND NOT EXISTS (SELECT 1 FROM habits WHERE id = habit_id AND is_active = 1)
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_habit_progress_total")
+    conn.execute("CREATE INDEX idx_habit_progress_unswept ON habit_progress (habit_id) WHERE total >= 21 AND swept = 0")
+
+
+# Серии считаются по дням расписания привычки, а не по календарным дням подряд
+def migrate_recount_streaks(conn):
+    rebuild_habit_progress(conn)
+
+
+# Планировщик читает расписание из строки привычки: лента habit_changes
+# и так и не использованная scheduler_state больше не нужны
+def migrate_drop_schedule_feed(conn):
+    conn.execute("DROP TABLE IF EXISTS habit_changes")
+    conn.execute("DROP TABLE IF EXISTS scheduler_state")
+
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_habit_progress,
+    migrate_indexes,
+    migrate_scheduler_state,
+    migrate_motivation_cache,
+    migrate_fsm_storage,
+    migrate_leader_and_changes,
+    migrate_outbox,
+    migrate_progress_total_index,
+    migrate_timezones,
+    migrate_local_days,
+    migrate_habit_analytics,
+    migrate_user_settings,
+    migrate_fsm_versions,
+    migrate_progress_swept,
+    migrate_recount_streaks,
+    migrate_drop_schedule_feed,
+]
+
+
+def init_db(path: str):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        db_log.info("Applied migration %d: %s", number, migration.__name__)
+    conn.close()
+
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+# Дни в habit_logs хранятся числом: номер дня от 1970-01-01
+def day_number(day: date) -> int:
+    return day.toordinal() - EPOCH_ORDINAL
+
+
+def day_date(day: int) -> date:
+    return date.fromordinal(day + EPOCH_ORDINAL)
+
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+EVERY_DAY_MASK = (1 << 7) - 1
+
+
+def days_mask(days: str) -> int:
+    mask = 0
+    for day in days.split(","):
+        day = day.strip()
+        if day in WEEKDAYS:
+            mask |= 1 << WEEKDAYS.index(day)
+    return mask
+
+
+# Ближайший день расписания строго до day; пустое расписание считаем ежедневным
+def previous_scheduled_day(mask: int, day: int) -> int:
+    mask = mask or EVERY_DAY_MASK
+    for back in range(1, 8):
+        if mask >> day_date(day - back).weekday() & 1:
+            return day - back
+    return day - 1
+
+
+# Серия не прерывается, пока не пропущен ни один день расписания: у привычки
+# по понедельникам, средам и пятницам среда продолжает серию понедельника
+def streak_alive(mask: int, last_log_day: int | None, day: int) -> bool:
+    return last_log_day is not None and last_log_day >= previous_scheduled_day(mask, day)
+
+
+def next_streak(last_log_day: int | None, current_streak: int, today: int, status: str, mask: int) -> int:
+    if status != "done":
+        return 0
+    if streak_alive(mask, last_log_day, today):
+        return current_streak + 1
+    return 1
+
+
+# Серия на сегодня: сохранённая обнуляется, если с последнего лога пропущен день расписания
+def streak_on(day: int, mask: int, last_log_day: int | None, current_streak: int) -> int:
+    return current_streak if streak_alive(mask, last_log_day, day) else 0
+
+
+# Пересчёт habit_progress и habit_weekday_stats по логам: всех привычек (для миграций
+# уже существующей базы) или только habit_ids — после импорта истории.
+def rebuild_habit_progress(conn, habit_ids: list[int] | None = None):
+    where, habits_where, params = "", "", ()
+    if habit_ids is not None:
+        placeholders = ",".join("?" * len(habit_ids))
+        where, habits_where = f"WHERE habit_id IN ({placeholders})", f"WHERE id IN ({placeholders})"
+        params = tuple(habit_ids)
+    conn.execute(f"DELETE FROM habit_progress {where}", params)
+    conn.execute(f"DELETE FROM habit_weekday_stats {where}", params)
+    masks = {
+        habit_id: days_mask(days)
+        for habit_id, days in conn.execute(f"SELECT id, days FROM habits {habits_where}", params)
+    }
+    progress = {}
+    weekdays = {}
+    logs = conn.execute(f"SELECT habit_id, user_id, day, status FROM habit_logs {where} ORDER BY habit_id, day", params)
+    for habit_id, user_id, log_day, status in logs:
+        row = progress.setdefault(habit_id, {"user_id": user_id, "done": 0, "partial": 0, "missed": 0, "total": 0,
+                                             "last_log_day": None, "current_streak": 0, "longest_streak": 0})
+        if status in ("done", "partial", "missed"):
+            row[status] += 1
+        row["total"] += 1
+        row["current_streak"] = next_streak(row["last_log_day"], row["current_streak"], log_day, status,
+                                            masks.get(habit_id, 0))
+        row["longest_streak"] = max(row["longest_streak"], row["current_streak"])
+        row["last_log_day"] = log_day
+
+        stats = weekdays.setdefault((habit_id, day_date(log_day).weekday()), [0, 0])
+        stats[0] += status == "done"
+        stats[1] += 1
+    conn.executemany("""
+        INSERT INTO habit_progress (habit_id, user_id, done, partial, missed, total, last_log_day, current_streak,
+                                    longest_streak)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (habit_id, row["user_id"], row["done"], row["partial"], row["missed"],
+         row["total"], row["last_log_day"], row["current_streak"], row["longest_streak"])
+        for habit_id, row in progress.items()
+    ])
+    conn.executemany(
+        "INSERT INTO habit_weekday_stats (habit_id, weekday, done, total) VALUES (?, ?, ?, ?)",
+        [(habit_id, weekday, done, total) for (habit_id, weekday), (done, total) in weekdays.items()]
+    )
+
+
+init_db(DB_PATH)
+db = Database(DB_PATH, readers=DB_READERS)
+
+
+# FSM-хранилище в SQLite. Горячие сессии держатся в памяти (не дольше FSM_CACHE_TTL,
+# чтобы несколько процессов видели изменения друг друга), а записи копятся и
+# уходят в базу одной транзакцией через FSM_FLUSH_DELAY. Запись идёт по версии строки
+# (compare-and-set): если другой процесс успел её изменить, наша копия отбрасывается
+# и перечитывается, а не перетирает более новые данные.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database: Database, cache_ttl: float, flush_delay: float, cache_size: int):
+        self.db = database
+        self.cache_ttl = cache_ttl
+        self.flush_delay = flush_delay
+        self.cache_size = cache_size
+        # ключ -> [state, data, время загрузки, версия в базе (0 — строки нет)]
+        self.cache: OrderedDict[str, list] = OrderedDict()
+        # ключ -> номер локального изменения; ключ остаётся здесь, пока запись не закоммичена
+        self.dirty: dict[str, int] = {}
+        self._changes = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+    async def _record(self, key: StorageKey) -> list:
+        storage_key = self._key(key)
+        record = self.cache.get(storage_key)
+        if record is not None and (storage_key in self.dirty or time.monotonic() - record[2] < self.cache_ttl):
+            self.cache.move_to_end(storage_key)
+            return record
+
+        row = await self.db.fetchone(
+            "SELECT state, data, version FROM fsm_storage WHERE storage_key = ?", (storage_key,)
+        )
+        # Пока читали, запись могла измениться локально — её не перетираем
+        if storage_key in self.dirty:
+            return self.cache[storage_key]
+        if row:
+            record = [row[0], json.loads(row[1]), time.monotonic(), row[2]]
+        else:
+            record = [None, {}, time.monotonic(), 0]
+        self.cache[storage_key] = record
+        self._evict()
+        return record
+
+    def _evict(self):
+        while len(self.cache) > self.cache_size:
+            for storage_key in self.cache:
+                if storage_key not in self.dirty:
+                    del self.cache[storage_key]
+                    break
+            else:
+                return
+
+    # Без задержки (несколько воркеров) запись коммитится до возврата из хэндлера,
+    # иначе следующий апдейт пользователя в другом воркере прочитал бы старое состояние
+    async def _mark_dirty(self, key: StorageKey):
+        self._changes += 1
+        self.dirty[self._key(key)] = self._changes
+        if self.flush_delay <= 0:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    # Изменения, сделанные во время записи, уходят следующим проходом;
+    # после ошибки ждём следующего изменения
+    async def _delayed_flush(self):
+        while self.dirty:
+            await asyncio.sleep(self.flush_delay)
+            if not await self.flush():
+                return
+
+    # Пишет строку, только если её версия не изменилась с момента чтения.
+    # Возвращает новую версию или None при конфликте.
+    @staticmethod
+    def _write_record(conn, storage_key: str, state: str | None, data: str | None, version: int) -> int | None:
+        if data is None:
+            conn.execute("DELETE FROM fsm_storage WHERE storage_key = ? AND version = ?", (storage_key, version))
+            exists = conn.execute("SELECT 1 FROM fsm_storage WHERE storage_key = ?", (storage_key,)).fetchone()
+            return None if exists else 0
+        if version == 0:
+            written = conn.execute("""
+                INSERT INTO fsm_storage (storage_key, state, data, updated_at, version) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (storage_key) DO NOTHING
+            """, (storage_key, state, data, int(time.time()))).rowcount
+        else:
+            written = conn.execute("""
+                UPDATE fsm_storage SET state = ?, data = ?, updated_at = ?, version = version + 1
+                WHERE storage_key = ? AND version = ?
+            """, (state, data, int(time.time()), storage_key, version)).rowcount
+        return version + 1 if written else None
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self.dirty:
+                return True
+            pending = dict(self.dirty)
+            writes = []
+            for storage_key in pending:
+                state, data, _, version = self.cache[storage_key]
+                if state is None and not data:
+                    writes.append((storage_key, None, None, version))
+                else:
+                    writes.append((storage_key, state, json.dumps(data, ensure_ascii=False), version))
+
+            def write(conn):
+                return {storage_key: self._write_record(conn, storage_key, *args) for storage_key, *args in writes}
+
+            try:
+                versions = await self.db.transaction(write)
+            except Exception as e:
+                # Ключи остались в dirty и уйдут со следующей записью
+                db_log.error("FSM storage flush failed: %s", e)
+                return False
+
+            for storage_key, change in pending.items():
+                version = versions[storage_key]
+                if version is None:
+                    db_log.warning("FSM record %s was changed by another process, reloading", storage_key)
+                    self.cache.pop(storage_key, None)
+                    self.dirty.pop(storage_key, None)
+                    continue
+                record = self.cache[storage_key]
+                record[2], record[3] = time.monotonic(), version
+                if self.dirty.get(storage_key) == change:
+                    del self.dirty[storage_key]
+            return True
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        record = await self._record(key)
+        record[1] = copy.deepcopy(data)
+        await self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return copy.deepcopy((await self._record(key))[1])
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage(db, FSM_CACHE_TTL, FSM_FLUSH_DELAY, FSM_CACHE_SIZE)
+
+
+class UserHabit:
+    __slots__ = ("id", "habit_name", "habit_description", "goal", "timezone_name", "timezone_offset", "is_active")
+
+    def __init__(self, id: int, habit_name: str, habit_description: str, goal: str,
+                 timezone_name: str | None, timezone_offset: float, is_active: int):
+        self.id = id
+        self.habit_name = habit_name
+        self.habit_description = habit_description
+        self.goal = goal
+        self.timezone_name = timezone_name
+        self.timezone_offset = timezone_offset
+        self.is_active = bool(is_active)
+
+
+# Привычки пользователя и выбранная в меню — LRU с TTL, чтобы кнопки меню
+# не ходили в habits на каждое нажатие. Изменения в этом процессе сбрасывают
+# запись сразу, TTL ограничивает устаревание после изменений из других процессов.
+# При нескольких webhook-воркерах TTL равен 0 и кэш не используется.
+class UserHabitCache:
+    def __init__(self, db: Database, max_size: int, ttl: float):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[float, list[UserHabit], int | None]] = OrderedDict()
+
+    async def _load(self, user_id: int) -> tuple[list[UserHabit], int | None]:
+        entry = self.entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self.entries.move_to_end(user_id)
+            return entry[1], entry[2]
+
+        rows = await self.db.fetchall("""
+            SELECT id, habit_name, habit_description, goal, timezone_name, timezone_offset, is_active
+            FROM habits WHERE user_id = ? ORDER BY id
+        """, (user_id,))
+        row = await self.db.fetchone("SELECT selected_habit_id FROM user_settings WHERE user_id = ?", (user_id,))
+        habits = [UserHabit(*habit) for habit in rows]
+        selected = row[0] if row else None
+
+        self.entries[user_id] = (time.monotonic(), habits, selected)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return habits, selected
+
+    async def active(self, user_id: int) -> list[UserHabit]:
+        habits, _ = await self._load(user_id)
+        return [habit for habit in habits if habit.is_active]
+
+    async def find(self, user_id: int, habit_id: int) -> UserHabit | None:
+        habits, _ = await self._load(user_id)
+        return next((habit for habit in habits if habit.id == habit_id), None)
+
+    # Выбранная привычка, иначе последняя активная, иначе последняя завершённая
+    async def current(self, user_id: int) -> UserHabit | None:
+        habits, selected = await self._load(user_id)
+        if not habits:
+            return None
+        active = [habit for habit in habits if habit.is_active]
+        for habit in active:
+            if habit.id == selected:
+                return habit
+        return active[-1] if active else habits[-1]
+
+    async def select(self, user_id: int, habit_id: int):
+        await self.db.execute("""
+            INSERT INTO user_settings (user_id, selected_habit_id) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET selected_habit_id = excluded.selected_habit_id
+        """, (user_id, habit_id))
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+
+
+user_habits = UserHabitCache(db, USER_HABIT_CACHE_SIZE, USER_HABIT_CACHE_TTL)
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
+dp = Dispatcher(storage=fsm_storage)
+
+MINUTES_PER_DAY = 24 * 60
+
+# Тепловая карта на экране прогресса: клетка на день, по неделе в строке
+HEATMAP_DAYS = 21
+HEATMAP_CELLS = {"done": "🟩", "partial": "🟨", "missed": "🟥"}
+
+# Популярные часовые пояса для клавиатуры, остальные можно ввести текстом
+COMMON_TIMEZONES = [
+    "Europe/London", "Europe/Berlin", "Europe/Kyiv",
+    "Europe/Moscow", "Asia/Dubai", "Asia/Kolkata",
+    "Asia/Shanghai", "Asia/Tokyo", "Australia/Sydney",
+    "America/New_York", "America/Chicago", "America/Los_Angeles",
+]
 
 class HabitStates(StatesGroup):
     CHOOSE_CATEGORY = State()
@@ -59,6 +924,7 @@ class HabitStates(StatesGroup):
     SET_GOAL = State()
     SELECT_DAYS = State()
     SELECT_TIME = State()
+    ENTER_TIMEZONE = State()
     CONFIRM_HABIT = State()
     AI_CHAT = State()
     CONFIRM_CANCEL = State()
@@ -69,6 +935,7 @@ main_menu_keyboard = ReplyKeyboardMarkup(
         [KeyboardButton(text="📈 My Progress")],
         [KeyboardButton(text="🧠 AI Assistant")],
         [KeyboardButton(text="💪 Motivation")],
+        [KeyboardButton(text="🔀 Switch Habit"), KeyboardButton(text="🆕 New Habit")],
         [KeyboardButton(text="❌ Cancel Habit")]
     ],
     resize_keyboard=True
@@ -118,6 +985,10 @@ def get_days_selection_message(selected_days: list):
 
 # Клавиатура для выбора часового пояса
 def get_timezone_keyboard():
+    zone_buttons = [
+        InlineKeyboardButton(text=name.split("/")[-1].replace("_", " "), callback_data=f"tzname:{name}")
+        for name in COMMON_TIMEZONES
+    ]
     buttons = []
     for offset in range(-12, 13):
         sign = "+" if offset >= 0 else ""
@@ -126,7 +997,9 @@ def get_timezone_keyboard():
         buttons.append(InlineKeyboardButton(text=text, callback_data=callback_data))
 
     # Группировка по 3 кнопки в ряд
-    keyboard_rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    keyboard_rows = [zone_buttons[i:i + 3] for i in range(0, len(zone_buttons), 3)]
+    keyboard_rows += [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    keyboard_rows.append([InlineKeyboardButton(text="⌨️ Type another timezone", callback_data="tzname_input")])
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
 
@@ -146,6 +1019,14 @@ completed_habit_keyboard = ReplyKeyboardMarkup(
     one_time_keyboard=False
 )
 
+
+# Перезапуск конкретной завершённой привычки — у пользователя их может быть несколько
+def restart_habit_keyboard(habits: list[tuple[int, str]]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🔁 {habit_name}", callback_data=f"restart_habit:{habit_id}")]
+        for habit_id, habit_name in habits
+    ])
+
 # Подтверждение создания привычки
 async def show_confirmation(message_or_callback, data):
     confirmation_text = (
@@ -155,7 +1036,7 @@ async def show_confirmation(message_or_callback, data):
         f"• Description: {data.get('habit_description')}\n"
         f"• Goal: {data.get('goal')}\n"
         f"• Days: {', '.join(data.get('selected_days', []))}\n"
-        f"• Timezone: UTC{data.get('timezone_offset'):+}\n"
+        f"• Timezone: {data.get('timezone_label')}\n"
         f"• Reminder Time: {data.get('reminder_time')}"
     )
 
@@ -200,8 +1081,194 @@ def static_congrats_message(done: int) -> str:
         )
     
 
+# Один HTTP-клиент на процесс: соединения с Together.ai переиспользуются между запросами
+http_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                keepalive_expiry=60
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0)
+        )
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+def retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return 0.5 * 2 ** attempt + random.uniform(0, 0.25)
+
+
+def record_llm_usage(usage: dict | None):
+    if usage:
+        LLM_TOKENS.inc("prompt", amount=usage.get("prompt_tokens") or 0)
+        LLM_TOKENS.inc("completion", amount=usage.get("completion_tokens") or 0)
+
+
+async def together_chat(payload: dict) -> dict:
+    started = time.perf_counter()
+    data = await post_chat_completion(payload)
+    outcome = "ok" if "choices" in data else "error"
+    LLM_LATENCY.observe(time.perf_counter() - started, "chat", outcome)
+    record_llm_usage(data.get("usage"))
+    llm_log.debug("Together.ai response: %s", data)
+    return data
+
+
+# Запрос к chat/completions с повтором при 429/5xx и сетевых ошибках
+async def post_chat_completion(payload: dict) -> dict:
+    client = get_http_client()
+    # На все паузы между повторами — не больше LLM_TIMEOUT
+    retry_deadline = time.monotonic() + LLM_TIMEOUT
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            response = await client.post(TOGETHER_API_URL, json={"model": TOGETHER_MODEL, **payload})
+        except httpx.TransportError as e:
+            if attempt == LLM_MAX_RETRIES:
+                return {"error": {"message": f"Connection error: {e}"}}
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+
+        if (response.status_code == 429 or response.status_code >= 500) and attempt < LLM_MAX_RETRIES:
+            # Ожидание держит слот llm_gate и задерживает ответ пользователю: если
+            # Retry-After не укладывается в оставшийся бюджет, сразу отдаём ошибку
+            delay = retry_delay(attempt, response)
+            if delay <= retry_deadline - time.monotonic():
+                await asyncio.sleep(delay)
+                continue
+            llm_log.warning("Together.ai asked to retry after %.0fs, giving up", delay)
+
+        try:
+            return response.json()
+        except ValueError:
+            return {"error": {"message": f"HTTP {response.status_code} from Together.ai"}}
+
+
+# Потоковый запрос к chat/completions (SSE), отдаёт куски текста по мере генерации
+async def together_chat_stream(payload: dict):
+    client = get_http_client()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        async with client.stream("POST", TOGETHER_API_URL, json={"model": TOGETHER_MODEL, "stream": True, **payload}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                response.raise_for_status()
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"].get("message", "Unknown error from Together.ai"))
+                record_llm_usage(chunk.get("usage"))
+                for choice in chunk.get("choices", []):
+                    content = (choice.get("delta") or {}).get("content") or choice.get("text")
+                    if content:
+                        yield content
+        outcome = "ok"
+    finally:
+        LLM_LATENCY.observe(time.perf_counter() - started, "stream", outcome)
+
+
+class LLMOverloaded(Exception):
+    pass
+
+
+LLM_OVERLOADED_TEXT = "⏳ I'm getting a lot of requests right now. Please try again in a minute."
+
+
+# Ограничение нагрузки на LLM: общий семафор с очередью ограниченной длины
+# и single-flight — одинаковые запросы, уже идущие в работу, делят один результат.
+class LLMGate:
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.in_flight: dict[tuple, asyncio.Task] = {}
+        self.active = 0
+
+    def is_idle(self) -> bool:
+        return self.active == 0 and self.waiting == 0
+
+    def _check_capacity(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            LLM_SHED.inc()
+            raise LLMOverloaded()
+
+    async def _acquire(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def _release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    async def _limited(self, factory):
+        await self._acquire()
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+    async def run(self, key: tuple, factory):
+        task = self.in_flight.get(key)
+        if task is not None:
+            LLM_COALESCED.inc()
+        else:
+            self._check_capacity()
+            task = asyncio.ensure_future(self._limited(factory))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    # Слот без объединения запросов — для потоковых ответов
+    @asynccontextmanager
+    async def slot(self):
+        self._check_capacity()
+        await self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+
+llm_gate = LLMGate(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+
 # Генерация мотивации для привычки
-async def generate_motivation(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int) -> str:
+def motivation_messages(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int) -> list[dict]:
     total = done + partial + missed
     day = f"{total}/21"
 
@@ -219,38 +1286,229 @@ async def generate_motivation(habit_name: str, description: str, goal: str, done
         "Make it clear why giving up is NOT an option. Use strong language and emojis to energize them."
     )
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.together.xyz/v1/chat/completions",
-            headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
-            json={
-                "model": "mistralai/Mistral-7B-Instruct-v0.2",
-                "messages": [
-                    {"role": "system", "content": "You are a powerful motivational coach who helps people build habits. \
-                      Your tone is direct, emotional, and inspiring, but also human and encouraging. \
-                      Speak in second person, use emojis, and end with a call to action."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.9,
-                "max_tokens": 180
-            }
-        )
+    return [
+        {"role": "system", "content": "You are a powerful motivational coach who helps people build habits. \
+          Your tone is direct, emotional, and inspiring, but also human and encouraging. \
+          Speak in second person, use emojis, and end with a call to action."},
+        {"role": "user", "content": prompt}
+    ]
 
-        data = response.json()
 
-        # 🔍 Печатаем весь ответ для отладки
-        print("[DEBUG] Together.ai response:")
-        print(data)
+async def generate_motivation(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int) -> str:
+    data = await together_chat({
+        "messages": motivation_messages(habit_name, description, goal, done, partial, missed),
+        "temperature": 0.9,
+        "max_tokens": 180
+    })
+
+    if "choices" not in data:
+        error_msg = data.get("error", {}).get("message", "Unknown error from Together.ai")
+        return f"⚠️ AI error: {error_msg}"
+
+    return data["choices"][0]["message"]["content"].strip()
+
+
+# Несколько вариантов мотивации одним запросом (параметр n), для фонового пула
+async def generate_motivation_variants(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int, count: int) -> list[str]:
+    data = await together_chat({
+        "messages": motivation_messages(habit_name, description, goal, done, partial, missed),
+        "temperature": 0.9,
+        "max_tokens": 180,
+        "n": count
+    })
+
+    if "choices" not in data:
+        error_msg = data.get("error", {}).get("message", "Unknown error from Together.ai")
+        llm_log.warning("Motivation pool generation failed: %s", error_msg)
+        return []
+
+    return [choice["message"]["content"].strip() for choice in data["choices"] if choice.get("message")]
+    
 
-        if "choices" not in data:
-            error_msg = data.get("error", {}).get("message", "Unknown error from Together.ai")
-            return f"⚠️ AI error: {error_msg}"
+def is_ai_error(text: str) -> bool:
+    return text.startswith("⚠️ AI error")
+
+
+# LRU-кэш с TTL для generate_motivation. Ключ — хэш привычки и прогресса,
+# на ключ хранится до MOTIVATION_VARIANTS ответов: пока их меньше, каждый тап
+# генерирует новый вариант, дальше варианты отдаются по кругу без запроса к API.
+class MotivationCache:
+    def __init__(self, max_size: int, ttl: int, variants: int, persist: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.persist = persist
+        self.entries: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self.rotation: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int) -> str:
+        raw = json.dumps([habit_name, description, goal, done, partial, missed], ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _drop(self, key: str):
+        self.entries.pop(key, None)
+        self.rotation.pop(key, None)
+
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            self._drop(key)
+            entry = None
+
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            MOTIVATION_CACHE_LOOKUPS.inc("miss")
+            return None
+
+        self.entries.move_to_end(key)
+        index = self.rotation.get(key, 0)
+        self.rotation[key] = (index + 1) % len(entry[1])
+        self.hits += 1
+        MOTIVATION_CACHE_LOOKUPS.inc("hit")
+        return entry[1][index]
+
+    def is_full(self, key: str) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and len(entry[1]) >= self.variants and time.time() - entry[0] <= self.ttl
+
+    def put(self, key: str, message: str, created_at: float | None = None):
+        created_at = created_at or time.time()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = (created_at, [message])
+        elif message not in entry[1] and len(entry[1]) < self.variants:
+            entry[1].append(message)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            old_key, _ = self.entries.popitem(last=False)
+            self.rotation.pop(old_key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    async def load(self):
+        if not self.persist:
+            return
+        cutoff = int(time.time() - self.ttl)
+        await db.execute("DELETE FROM motivation_cache WHERE created_at < ?", (cutoff,))
+        rows = await db.fetchall("""
+            SELECT cache_key, message, created_at FROM motivation_cache
+            ORDER BY created_at DESC LIMIT ?
+        """, (self.max_size * self.variants,))
+        for cache_key, message, created_at in reversed(rows):
+            self.put(cache_key, message, created_at)
+
+    async def store(self, key: str, message: str):
+        self.put(key, message)
+        if self.persist:
+            await db.execute("""
+                INSERT INTO motivation_cache (cache_key, message, created_at) VALUES (?, ?, ?)
+                ON CONFLICT (cache_key, message) DO NOTHING
+            """, (key, message, int(time.time())))
+
+
+motivation_cache = MotivationCache(
+    MOTIVATION_CACHE_SIZE, MOTIVATION_CACHE_TTL, MOTIVATION_VARIANTS, persist=MOTIVATION_CACHE_PERSIST
+)
 
-        return data["choices"][0]["message"]["content"].strip()
-    
 
-# Генерация совета от AI
-async def generate_ai_advice(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int, user_question: str) -> str:
+# Заранее сгенерированные мотивации по привычкам. Варианты привязаны к ключу
+# прогресса: как только в habit_logs появляется новая запись, ключ меняется
+# и старые варианты больше не отдаются.
+class MotivationPool:
+    def __init__(self, max_habits: int):
+        self.max_habits = max_habits
+        self.entries: dict[int, tuple[str, list[str]]] = {}
+
+    def take(self, habit_id: int, cache_key: str) -> str | None:
+        entry = self.entries.get(habit_id)
+        if entry is None:
+            return None
+        key, messages = entry
+        if key != cache_key or not messages:
+            del self.entries[habit_id]
+            return None
+        message = messages.pop()
+        if not messages:
+            del self.entries[habit_id]
+        return message
+
+    def needs(self, habit_id: int, cache_key: str) -> bool:
+        entry = self.entries.get(habit_id)
+        return entry is None or entry[0] != cache_key
+
+    def fill(self, habit_id: int, cache_key: str, messages: list[str]):
+        if messages and (habit_id in self.entries or len(self.entries) < self.max_habits):
+            self.entries[habit_id] = (cache_key, messages)
+
+    def invalidate(self, habit_id: int):
+        self.entries.pop(habit_id, None)
+
+
+motivation_pool = MotivationPool(MOTIVATION_POOL_MAX_HABITS)
+
+
+# Фоновое заполнение пула. Работает только пока LLM простаивает и уступает
+# место живым запросам пользователей.
+async def motivation_pool_worker():
+    while True:
+        await asyncio.sleep(MOTIVATION_POOL_INTERVAL)
+        if MOTIVATION_POOL_SIZE <= 0:
+            continue
+
+        try:
+            week_ago = day_number(datetime.now(UTC).date()) - 7
+            habits = await db.fetchall("""
+                SELECT h.id, h.habit_name, h.habit_description, h.goal,
+                       COALESCE(p.done, 0), COALESCE(p.partial, 0), COALESCE(p.missed, 0)
+                FROM habits h
+                LEFT JOIN habit_progress p ON p.habit_id = h.id
+                WHERE h.is_active = 1
+                  AND (p.last_log_day IS NULL OR p.last_log_day >= ?)
+            """, (week_ago,))
+        except Exception as e:
+            llm_log.error("Motivation pool query failed: %s", e)
+            continue
+
+        generated = 0
+        for habit_id, habit_name, description, goal, done, partial, missed in habits:
+            if generated >= MOTIVATION_POOL_BATCH or not llm_gate.is_idle():
+                break
+
+            cache_key = MotivationCache.make_key(habit_name, description, goal, done, partial, missed)
+            if not motivation_pool.needs(habit_id, cache_key) or motivation_cache.is_full(cache_key):
+                continue
+
+            try:
+                messages = await llm_gate.run(
+                    ("pool", habit_id, cache_key),
+                    lambda: generate_motivation_variants(
+                        habit_name, description, goal, done, partial, missed, MOTIVATION_POOL_SIZE
+                    )
+                )
+            except LLMOverloaded:
+                break
+            motivation_pool.fill(habit_id, cache_key, messages)
+            generated += 1
+
+        if generated:
+            llm_log.info("Pre-generated motivation generated=%d pooled=%d", generated, len(motivation_pool.entries))
+
+
+# Генерация совета от AI. history — последние реплики чата, summary — краткое
+# содержание более ранних, так что размер запроса не растёт с длиной разговора.
+def ai_advice_messages(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int, user_question: str,
+                       history: list | None = None, summary: str | None = None) -> list[dict]:
     total = done + partial + missed
     day = f"{total}/21"
 
@@ -270,29 +1528,114 @@ async def generate_ai_advice(habit_name: str, description: str, goal: str, done:
         "Based on the above, give your best answer."
     )
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.together.xyz/v1/chat/completions",
-            headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
-            json={
-                "model": "mistralai/Mistral-7B-Instruct-v0.2",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.85,
-                "max_tokens": 300
-            }
-        )
-
-        data = response.json()
-        print("[DEBUG] AI Assistant response:", data)
-
-        if "choices" not in data:
-            error_msg = data.get("error", {}).get("message", "Unknown error from Together.ai")
-            return f"⚠️ AI error: {error_msg}"
-
-        return data["choices"][0]["message"]["content"].strip()
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    messages += [{"role": role, "content": content} for role, content, _ in history or []]
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+
+async def generate_ai_advice(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int, user_question: str,
+                             history: list | None = None, summary: str | None = None) -> str:
+    data = await together_chat({
+        "messages": ai_advice_messages(habit_name, description, goal, done, partial, missed, user_question, history, summary),
+        "temperature": 0.85,
+        "max_tokens": 300
+    })
+
+    if "choices" not in data:
+        error_msg = data.get("error", {}).get("message", "Unknown error from Together.ai")
+        return f"⚠️ AI error: {error_msg}"
+
+    return data["choices"][0]["message"]["content"].strip()
+
+
+def stream_ai_advice(habit_name: str, description: str, goal: str, done: int, partial: int, missed: int, user_question: str,
+                     history: list | None = None, summary: str | None = None):
+    return together_chat_stream({
+        "messages": ai_advice_messages(habit_name, description, goal, done, partial, missed, user_question, history, summary),
+        "temperature": 0.85,
+        "max_tokens": 300
+    })
+
+
+# Грубая оценка длины текста в токенах: около 4 символов на токен
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+# Кольцевой буфер реплик: самые старые пары вопрос-ответ вытесняются, пока буфер
+# не уложится в CHAT_HISTORY_TURNS реплик и CHAT_HISTORY_TOKENS токенов.
+# Возвращает оставшиеся и вытесненные реплики.
+def trim_chat_history(history: list) -> tuple[list, list]:
+    tokens = sum(count for *_, count in history)
+    start = 0
+    while start < len(history) and (len(history) - start > CHAT_HISTORY_TURNS or tokens > CHAT_HISTORY_TOKENS):
+        for _, _, count in history[start:start + 2]:
+            tokens -= count
+        start += 2
+    return history[start:], history[:start]
+
+
+def chat_summary_messages(summary: str | None, turns: list) -> list[dict]:
+    dialogue = "\n".join(f"{role}: {content}" for role, content, _ in turns)
+    return [
+        {"role": "system", "content": (
+            "Summarize this conversation between a user and a habit coach. Keep facts about the user, "
+            f"their situation and advice already given. Write at most {CHAT_SUMMARY_TOKENS // 2} words."
+        )},
+        {"role": "user", "content": f"Previous summary: {summary or 'none'}\n\nNew messages:\n{dialogue}"}
+    ]
+
+
+# Краткое содержание вытесненных реплик вместе с прежним; None при ошибке AI
+async def summarize_chat(summary: str | None, turns: list) -> str | None:
+    data = await together_chat({
+        "messages": chat_summary_messages(summary, turns),
+        "temperature": 0.3,
+        "max_tokens": CHAT_SUMMARY_TOKENS
+    })
+    if "choices" not in data:
+        return None
+    return data["choices"][0]["message"]["content"].strip() or None
+
+
+# Показываем ответ по мере генерации, правя сообщение-заглушку не чаще STREAM_EDIT_INTERVAL
+async def stream_to_message(placeholder: Message, chunks) -> str:
+    chat_id = placeholder.chat.id
+    text = ""
+    shown = ""
+    last_edit = time.monotonic()
+
+    async for chunk in chunks:
+        text += chunk
+        partial_text = text.strip()
+        if not partial_text or partial_text == shown or time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+        last_edit = time.monotonic()
+        try:
+            await rate_limiter.acquire(chat_id)
+            await placeholder.edit_text(partial_text + " ▌")
+            shown = partial_text
+        except TelegramRetryAfter as e:
+            # Промежуточную правку можно пропустить, финальная всё равно будет
+            rate_limiter.pause(chat_id, e.retry_after)
+
+    final_text = text.strip()
+    if not final_text:
+        raise ValueError("Empty streamed response")
+
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        await rate_limiter.acquire(chat_id)
+        try:
+            await placeholder.edit_text(final_text)
+            break
+        except TelegramRetryAfter as e:
+            rate_limiter.pause(chat_id, e.retry_after)
+            if attempt == SEND_MAX_ATTEMPTS:
+                raise
+    return final_text
 
 
 @dp.message(Command("start"))
@@ -304,6 +1647,167 @@ async def start_cmd(message: Message, state: FSMContext):
     )
 
 
+# Выгрузка истории: привычки и их логи одним потоком записей. Курсор читается
+# пачками по EXPORT_BATCH строк, так что память не зависит от размера истории.
+# Одни и те же записи пишутся в CSV (пустые ячейки у чужих полей) или JSONL.
+EXPORT_FORMATS = ("csv", "jsonl")
+HABIT_EXPORT_FIELDS = ["habit_id", "user_id", "category", "habit_name", "habit_description", "goal", "days",
+                       "timezone_offset", "timezone_name", "reminder_time", "is_active"]
+EXPORT_FIELDS = ["record", *HABIT_EXPORT_FIELDS, "date", "status"]
+
+
+def fetch_batches(cursor):
+    while rows := cursor.fetchmany(EXPORT_BATCH):
+        yield from rows
+
+
+def export_records(conn, user_id: int | None = None):
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    habits = conn.execute(f"""
+        SELECT id, user_id, category, habit_name, habit_description, goal, days, timezone_offset, timezone_name,
+               reminder_time, is_active
+        FROM habits {where} ORDER BY id
+    """, params)
+    for row in fetch_batches(habits):
+        yield {"record": "habit", **dict(zip(HABIT_EXPORT_FIELDS, row))}
+
+    # Логи пользователя выбираем по его привычкам — это диапазоны первичного ключа
+    where = "WHERE habit_id IN (SELECT id FROM habits WHERE user_id = ?)" if user_id is not None else ""
+    logs = conn.execute(f"SELECT habit_id, user_id, day, status FROM habit_logs {where} ORDER BY habit_id, day", params)
+    for habit_id, log_user_id, day, status in fetch_batches(logs):
+        yield {"record": "log", "habit_id": habit_id, "user_id": log_user_id, "date": day_date(day).isoformat(),
+               "status": status}
+
+
+# Пишет выгрузку в файл, возвращает число записей
+def write_export(conn, path: str, export_format: str, user_id: int | None = None) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        if export_format == "csv":
+            writer = csv.DictWriter(file, EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(record):
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        for record in export_records(conn, user_id):
+            write(record)
+            count += 1
+    return count
+
+
+def read_export(path: str, export_format: str):
+    with open(path, encoding="utf-8", newline="") as file:
+        if export_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def habit_owners(conn, habit_ids) -> dict[int, int]:
+    habit_ids = list(habit_ids)
+    if not habit_ids:
+        return {}
+    return dict(conn.execute(
+        f"SELECT id, user_id FROM habits WHERE id IN ({','.join('?' * len(habit_ids))})", habit_ids
+    ).fetchall())
+
+
+# Загрузка пачки записей. id привычек сохраняются, поэтому повторный импорт той же
+# выгрузки ничего не дублирует. Если id в базе уже занят привычкой другого
+# пользователя, привычка и её логи пропускаются и попадают в отчёт.
+# Возвращает (привычек добавлено, логов добавлено, id конфликтующих привычек, логов пропущено).
+def import_records(conn, records: list[dict]) -> tuple[int, int, list[int], int]:
+    habits = []
+    logs = []
+    for record in records:
+        if record["record"] == "habit":
+            timezone_name = record.get("timezone_name") or None
+            timezone_offset = float(record["timezone_offset"])
+            slot = HabitSlot.from_row(record["days"], record["reminder_time"], timezone_name, timezone_offset)
+            habits.append((int(record["habit_id"]), int(record["user_id"]), record["category"], record["habit_name"],
+                           record["habit_description"], record["goal"], record["days"], timezone_offset,
+                           record["reminder_time"], int(record["is_active"]), timezone_name,
+                           next_fire_at(slot, int(time.time()))))
+        elif record["record"] == "log":
+            habit_id, user_id = int(record["habit_id"]), int(record["user_id"])
+            logs.append((habit_id, day_number(date.fromisoformat(record["date"])), user_id, record["status"]))
+
+    owners = habit_owners(conn, {row[0] for row in habits})
+    conflicts = [row[0] for row in habits if owners.get(row[0], row[1]) != row[1]]
+    if conflicts:
+        db_log.warning("Skipped imported habits whose ids belong to other users: %s", conflicts)
+        habits = [row for row in habits if owners.get(row[0], row[1]) == row[1]]
+
+    before = conn.total_changes
+    conn.executemany("""
+        INSERT OR IGNORE INTO habits (id, user_id, category, habit_name, habit_description, goal, days,
+                                      timezone_offset, reminder_time, is_active, timezone_name, next_fire_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, habits)
+    added_habits = conn.total_changes - before
+
+    # Лог принимается, только если его привычка в базе принадлежит тому же пользователю
+    owners = habit_owners(conn, {row[0] for row in logs})
+    accepted = [row for row in logs if owners.get(row[0]) == row[2]]
+    skipped_logs = len(logs) - len(accepted)
+    logs = accepted
+
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO habit_logs (habit_id, day, user_id, status) VALUES (?, ?, ?, ?)", logs
+    )
+    added_logs = conn.total_changes - before
+
+    # Прогресс и статистика по дням недели пересчитываются по полной истории
+    # затронутых привычек: логи в выгрузке идут по habit_id, так что привычек в пачке мало
+    habit_ids = sorted({row[0] for row in logs})
+    if habit_ids:
+        rebuild_habit_progress(conn, habit_ids)
+    return added_habits, added_logs, conflicts, skipped_logs
+
+
+# Импорт пачками по IMPORT_BATCH записей, каждая — своя транзакция.
+# Возвращает (привычек добавлено, логов добавлено, привычек пропущено, логов пропущено).
+async def import_export_file(path: str, export_format: str) -> tuple[int, int, int, int]:
+    totals = [0, 0, 0, 0]
+
+    async def import_batch(batch):
+        added_habits, added_logs, conflicts, skipped_logs = await db.transaction(import_records, batch)
+        for index, value in enumerate((added_habits, added_logs, len(conflicts), skipped_logs)):
+            totals[index] += value
+
+    batch = []
+    for record in read_export(path, export_format):
+        batch.append(record)
+        if len(batch) >= IMPORT_BATCH:
+            await import_batch(batch)
+            batch = []
+    if batch:
+        await import_batch(batch)
+    return tuple(totals)
+
+
+@dp.message(Command("export"))
+async def export_cmd(message: Message, command: CommandObject):
+    user_id = message.from_user.id
+    export_format = (command.args or "csv").strip().lower()
+    if export_format not in EXPORT_FORMATS:
+        await message.answer("❌ Use /export csv or /export jsonl.")
+        return
+
+    # Выгрузка пишется во временный файл в потоке чтения и уходит документом
+    with tempfile.TemporaryDirectory(prefix="habit-export-") as directory:
+        path = os.path.join(directory, f"21day-{user_id}.{export_format}")
+        count = await db.read(write_export, path, export_format, user_id)
+        if count == 0:
+            await message.answer("❌ You don't have any habits to export yet.")
+            return
+        await message.answer_document(FSInputFile(path), caption="📦 Your habits and history")
+
+
 @dp.callback_query(F.data == "start_habit")
 async def process_start_button(callback: CallbackQuery, state: FSMContext):
     await callback.message.delete()
@@ -325,9 +1829,8 @@ async def process_category(callback: CallbackQuery, state: FSMContext):
 
 @dp.message(HabitStates.ENTER_HABIT_NAME)
 async def process_habit_name(message: Message, state: FSMContext):
-    await state.update_data(habit_name=message.text)
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("timezone_offset") and data.get("reminder_time"):
+    data = await state.update_data(habit_name=message.text)
+    if data.get("category") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("timezone_label") and data.get("reminder_time"):
         await show_confirmation(message, data)
         await state.set_state(HabitStates.CONFIRM_HABIT)
     else:
@@ -337,9 +1840,8 @@ async def process_habit_name(message: Message, state: FSMContext):
 
 @dp.message(HabitStates.ENTER_HABIT_DESCRIPTION)
 async def process_habit_description(message: Message, state: FSMContext):
-    await state.update_data(habit_description=message.text)
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_name") and data.get("goal") and data.get("selected_days") and data.get("timezone_offset") and data.get("reminder_time"):
+    data = await state.update_data(habit_description=message.text)
+    if data.get("category") and data.get("habit_name") and data.get("goal") and data.get("selected_days") and data.get("timezone_label") and data.get("reminder_time"):
         await show_confirmation(message, data)
         await state.set_state(HabitStates.CONFIRM_HABIT)
     else:
@@ -349,9 +1851,8 @@ async def process_habit_description(message: Message, state: FSMContext):
 
 @dp.message(HabitStates.SET_GOAL)
 async def process_goal(message: Message, state: FSMContext):
-    await state.update_data(goal=message.text)
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("selected_days") and data.get("timezone_offset") and data.get("reminder_time"):
+    data = await state.update_data(goal=message.text)
+    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("selected_days") and data.get("timezone_label") and data.get("reminder_time"):
         await show_confirmation(message, data)
         await state.set_state(HabitStates.CONFIRM_HABIT)
     else:
@@ -378,7 +1879,7 @@ async def toggle_day(callback: CallbackQuery, state: FSMContext):
         try:
             await callback.message.edit_reply_markup(reply_markup=keyboard)
         except Exception as e2:
-            print(f"[DEBUG] error at edit_reply_markup: {e2}")
+            bot_log.debug("Error at edit_reply_markup: %s", e2)
     await callback.answer()
 
 
@@ -389,9 +1890,7 @@ async def days_done(callback: CallbackQuery, state: FSMContext):
     if not selected_days:
         await callback.answer("Please select at least one day.", show_alert=True)
         return
-    await state.update_data(selected_days=selected_days)
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("timezone_offset") and data.get("reminder_time"):
+    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("timezone_label") and data.get("reminder_time"):
         await callback.message.delete()
         await show_confirmation(callback.message, data)
         await state.set_state(HabitStates.CONFIRM_HABIT)
@@ -400,19 +1899,64 @@ async def days_done(callback: CallbackQuery, state: FSMContext):
         await state.set_state(HabitStates.SELECT_TIME)
 
 
+# Часовой пояс IANA по имени; None, если такого нет
+def find_timezone(name: str) -> ZoneInfo | None:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+async def timezone_selected(message: Message, state: FSMContext, data: dict):
+    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("reminder_time"):
+        await show_confirmation(message, data)
+        await state.set_state(HabitStates.CONFIRM_HABIT)
+    else:
+        await message.answer("⏰ Now enter the time for the reminder (e.g. 07:00):")
+        await state.set_state(HabitStates.SELECT_TIME)
+
+
 # Handler for timezone selection
 @dp.callback_query(F.data.startswith("timezone:"), HabitStates.SELECT_TIME)
 async def process_timezone(callback: CallbackQuery, state: FSMContext):
     offset = int(callback.data.split(":")[1])
-    await state.update_data(timezone_offset=offset)
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("reminder_time"):
-        await callback.message.delete()
-        await show_confirmation(callback.message, data)
-        await state.set_state(HabitStates.CONFIRM_HABIT)
-    else:
-        await callback.message.delete()
-        await callback.message.answer("⏰ Now enter the time for the reminder (e.g. 07:00):")
+    data = await state.update_data(timezone_offset=offset, timezone_name=None, timezone_label=f"UTC{offset:+}")
+    await callback.message.delete()
+    await timezone_selected(callback.message, state, data)
+
+
+@dp.callback_query(F.data.startswith("tzname:"), HabitStates.SELECT_TIME)
+async def process_timezone_name(callback: CallbackQuery, state: FSMContext):
+    name = callback.data.split(":", 1)[1]
+    zone = find_timezone(name)
+    if zone is None:
+        await callback.answer("Unknown timezone.", show_alert=True)
+        return
+    data = await state.update_data(
+        timezone_offset=utc_offset_hours(zone), timezone_name=name, timezone_label=name
+    )
+    await callback.message.delete()
+    await timezone_selected(callback.message, state, data)
+
+
+@dp.callback_query(F.data == "tzname_input", HabitStates.SELECT_TIME)
+async def ask_timezone_name(callback: CallbackQuery, state: FSMContext):
+    await callback.message.delete()
+    await callback.message.answer("🌍 Enter your timezone name (e.g. Europe/Paris, America/Toronto):")
+    await state.set_state(HabitStates.ENTER_TIMEZONE)
+
+
+@dp.message(HabitStates.ENTER_TIMEZONE)
+async def process_timezone_input(message: Message, state: FSMContext):
+    name = message.text.strip()
+    zone = find_timezone(name)
+    if zone is None:
+        await message.answer("❌ Unknown timezone. Please enter a name like Europe/Paris.")
+        return
+    data = await state.update_data(
+        timezone_offset=utc_offset_hours(zone), timezone_name=name, timezone_label=name
+    )
+    await timezone_selected(message, state, data)
 
 
 # Handler for time input
@@ -430,10 +1974,8 @@ async def process_time(message: Message, state: FSMContext):
         await message.answer("❌ Invalid time format. Please enter time as HH:MM.")
         return
 
-    await state.update_data(reminder_time=formatted_time)
-
-    data = await state.get_data()
-    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("timezone_offset"):
+    data = await state.update_data(reminder_time=formatted_time)
+    if data.get("category") and data.get("habit_name") and data.get("habit_description") and data.get("goal") and data.get("selected_days") and data.get("timezone_label"):
         await show_confirmation(message, data)
         await state.set_state(HabitStates.CONFIRM_HABIT)
     else:
@@ -485,6 +2027,18 @@ async def edit_time(callback: CallbackQuery, state: FSMContext):
     await state.set_state(HabitStates.SELECT_TIME)
 
 
+def create_habit(conn, user_id: int, category: str, habit_name: str, habit_description: str, goal: str,
+                 days_str: str, timezone_offset: float, reminder_time: str, timezone_name: str | None = None) -> int:
+    slot = HabitSlot.from_row(days_str, reminder_time, timezone_name, timezone_offset)
+    habit_id = conn.execute("""
+    INSERT INTO habits (user_id, category, habit_name, habit_description, goal, days, timezone_offset, reminder_time,
+                        is_active, timezone_name, next_fire_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, category, habit_name, habit_description, goal, days_str, timezone_offset, reminder_time, 1,
+          timezone_name, next_fire_at(slot, int(time.time())))).lastrowid
+    return habit_id
+
+
 @dp.callback_query(F.data == "confirm_habit", HabitStates.CONFIRM_HABIT)
 async def confirm_habit(callback: CallbackQuery, state: FSMContext):
     await callback.message.delete()
@@ -497,194 +2051,606 @@ async def confirm_habit(callback: CallbackQuery, state: FSMContext):
     goal = data.get("goal")
     days = data.get("selected_days")
     timezone_offset = data.get("timezone_offset")
+    timezone_name = data.get("timezone_name")
     reminder_time = data.get("reminder_time")
 
     days_str = ",".join(days)  # превращает список в строку
 
 
-    cursor.execute("""
-    INSERT INTO habits (user_id, category, habit_name, habit_description, goal, days, timezone_offset, reminder_time, is_active)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, category, habit_name, habit_description, goal, days_str, timezone_offset, reminder_time, 1))
+    habit_id = await db.transaction(
+        create_habit, user_id, category, habit_name, habit_description, goal, days_str, timezone_offset, reminder_time,
+        timezone_name
+    )
+    await user_habits.select(user_id, habit_id)
 
     await callback.message.answer("🎉 Your habit has been successfully created!")
     await callback.message.answer("💬 Here's what you can do next:", reply_markup=main_menu_keyboard)
 
-    conn.commit()
-
     await state.clear()
 
 
-async def reminder_scheduler():
-    while True:
-        now = datetime.now(UTC)
-        current_time = now.strftime("%H:%M")
-        current_weekday = now.strftime("%A")
-
-        cursor.execute("SELECT * FROM habits")
-        habits = cursor.fetchall()
-
-        for habit in habits:
-            (
-                habit_id,
-                user_id,
-                category,
-                habit_name,
-                habit_description,
-                goal,
-                days,
-                timezone_offset,
-                reminder_time,
-                is_active
-            ) = habit
-
-            if is_active == 0:
-                continue
+# Расписание привычки для расчёта next_fire_at: дни недели — 7-битная маска
+# (по местному календарю), время — минута суток, часовой пояс — объект tzinfo
+class HabitSlot:
+    __slots__ = ("days_mask", "minute", "zone")
+
+    def __init__(self, days_mask: int, minute: int, zone):
+        self.days_mask = days_mask
+        self.minute = minute
+        self.zone = zone
+
+    @classmethod
+    def from_row(cls, days: str, reminder_time: str, timezone_name: str | None, timezone_offset: float) -> "HabitSlot":
+        hours, minutes = map(int, reminder_time.split(":"))
+        return cls(days_mask(days), hours * 60 + minutes, habit_zone(timezone_name, timezone_offset))
+
+
+# Пояс привычки: IANA-зона (с переходом на летнее время) или, для старых
+# привычек и кнопок UTC±N, фиксированное смещение
+def habit_zone(timezone_name: str | None, timezone_offset: float):
+    zone = find_timezone(timezone_name) if timezone_name else None
+    return zone or timezone(timedelta(hours=timezone_offset))
+
+
+# Текущее смещение в часах; у поясов вроде Asia/Kolkata оно дробное (5.5)
+def utc_offset_hours(zone) -> float:
+    return datetime.now(zone).utcoffset().total_seconds() / 3600
+
+
+# Ближайшее напоминание строго после момента after (оба — UTC, секунды от эпохи).
+# Дни недели и время считаются по местным часам, поэтому переход на летнее время
+# и полночь в чужом поясе не сдвигают напоминание на другой день.
+def next_fire_at(slot: HabitSlot, after: int) -> int | None:
+    if not slot.days_mask:
+        return None
+    hours, minutes = divmod(slot.minute, 60)
+    local_day = datetime.fromtimestamp(after, slot.zone).date()
+    for shift in range(8):
+        day = local_day + timedelta(days=shift)
+        if not slot.days_mask & (1 << day.weekday()):
+            continue
+        fire_at = int(datetime(day.year, day.month, day.day, hours, minutes, tzinfo=slot.zone).timestamp())
+        if fire_at > after:
+            return fire_at
+    return None
+
+
+def schedule_habits(conn, schedule: list[tuple[int | None, int]]):
+    conn.executemany("UPDATE habits SET next_fire_at = ? WHERE id = ? AND next_fire_at IS NULL", schedule)
+
+
+# Привычкам без next_fire_at (созданным до его появления) он считается один раз при старте
+async def schedule_unscheduled_habits():
+    habits = await db.fetchall("""
+        SELECT id, days, reminder_time, timezone_name, timezone_offset
+        FROM habits WHERE is_active = 1 AND next_fire_at IS NULL
+    """)
+    now = int(time.time())
+    schedule = [(next_fire_at(HabitSlot.from_row(*row), now), habit_id) for habit_id, *row in habits]
+    if schedule:
+        await db.transaction(schedule_habits, schedule)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+    # Остановить выдачу токенов, например после 429 от Telegram
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Общий лимит бота плюс отдельное ведро на каждый чат
+class TelegramRateLimiter:
+    def __init__(self, global_rate: float, chat_rate: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.max_chats = max_chats
+        self.chat_buckets: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chats:
+                self.chat_buckets = {
+                    cid: b for cid, b in self.chat_buckets.items() if not b.is_idle()
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    async def acquire(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def pause(self, chat_id: int, seconds: float):
+        self._chat_bucket(chat_id).pause(seconds)
+        self.global_bucket.pause(seconds)
+
+
+rate_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+
+
+async def send_with_retry(chat_id: int, text: str, **kwargs):
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        await rate_limiter.acquire(chat_id)
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except TelegramRetryAfter as e:
+            TELEGRAM_SEND_ERRORS.inc("TelegramRetryAfter")
+            sender_log.warning("Flood control chat=%d retry_after=%ss attempt=%d", chat_id, e.retry_after, attempt)
+            rate_limiter.pause(chat_id, e.retry_after)
+            if attempt == SEND_MAX_ATTEMPTS:
+                raise
+        except Exception as e:
+            TELEGRAM_SEND_ERRORS.inc(type(e).__name__)
+            raise
+
+
+# Сообщение для outbox: текст, parse_mode и клавиатура в JSON
+def outbox_payload(text: str, reply_markup=None, parse_mode: str | None = None) -> str:
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def payload_kwargs(payload: str) -> dict:
+    kwargs = json.loads(payload)
+    markup = kwargs.get("reply_markup")
+    if markup is not None:
+        if "inline_keyboard" in markup:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate(markup)
+        else:
+            kwargs["reply_markup"] = ReplyKeyboardMarkup.model_validate(markup)
+    return kwargs
+
+
+# rows: (idempotency_key, chat_id, payload). Повторная постановка с тем же ключом игнорируется.
+def enqueue_messages(conn, rows: list[tuple[str, int, str]]) -> int:
+    now = time.time()
+    return conn.executemany("""
+        INSERT INTO outbox (idempotency_key, chat_id, payload, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (idempotency_key) DO NOTHING
+    """, [(key, chat_id, payload, now, now) for key, chat_id, payload in rows]).rowcount
+
+
+# Забираем пачку готовых к отправке сообщений. Забранные строки откладываются на
+# OUTBOX_CLAIM_TIMEOUT: если отправитель упадёт, их заберут снова (at-least-once).
+def claim_outbox(conn, limit: int) -> list[tuple]:
+    now = time.time()
+    rows = conn.execute("""
+        UPDATE outbox SET next_attempt_at = ?, attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        )
+        RETURNING id, chat_id, payload, attempts
+    """, (now + OUTBOX_CLAIM_TIMEOUT, now, limit)).fetchall()
+    return sorted(rows)
 
-            # Получаем прогресс по привычке
-            cursor.execute("SELECT status FROM habit_logs WHERE user_id = ? AND habit_id = ?", (user_id, habit_id))
-            logs = cursor.fetchall()
 
-            done = sum(1 for (status,) in logs if status == "done")
-            partial = sum(1 for (status,) in logs if status == "partial")
-            missed = sum(1 for (status,) in logs if status == "missed")
-            completed_days = done + partial + missed
+def complete_outbox(conn, sent: list[int], retries: list[tuple[int, float, str]], failed: list[tuple[int, str]]):
+    now = time.time()
+    conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ? WHERE id = ?", [(now, row_id) for row_id in sent])
+    conn.executemany(
+        "UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+        [(retry_at, error, row_id) for row_id, retry_at, error in retries]
+    )
+    conn.executemany(
+        "UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?",
+        [(error, row_id) for row_id, error in failed]
+    )
 
-            # Завершение привычки после 21 дня
-            if completed_days >= 21:
-                cursor.execute("UPDATE habits SET is_active = 0 WHERE id = ?", (habit_id,))
-                conn.commit()
 
-                congrats = static_congrats_message(done)
-                await bot.send_message(user_id, f"🎉 {congrats}")
-                await bot.send_message(user_id, "💬 Here's what you can do next:", reply_markup=completed_habit_keyboard)
-                continue
+# Рассылка пачки из outbox пулом воркеров. Сообщения одному чату уходят по порядку;
+# если одно не ушло, остальные сообщения этого чата ждут его повтора.
+async def deliver_outbox(rows: list[tuple]) -> tuple[list, list, list]:
+    by_chat: dict[int, list[tuple]] = {}
+    for row in rows:
+        by_chat.setdefault(row[1], []).append(row)
 
-            # Корректировка времени с учётом таймзоны
-            user_hour = (now.hour + timezone_offset) % 24
-            user_time = f"{user_hour:02d}:{now.strftime('%M')}"
-
-            habit_days = [d.strip() for d in days.split(",")]
-            if reminder_time == user_time and current_weekday in habit_days:
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="✅ Done", callback_data=f"done:{habit_id}"),
-                        InlineKeyboardButton(text="⚠️ Partially", callback_data=f"partial:{habit_id}"),
-                        InlineKeyboardButton(text="❌ Missed", callback_data=f"missed:{habit_id}")
-                    ]
-                ])
+    queue = asyncio.Queue()
+    for chat_rows in by_chat.values():
+        queue.put_nowait(chat_rows)
+
+    sent = []
+    retries = []
+    failed = []
+
+    async def worker():
+        while not queue.empty():
+            chat_rows = queue.get_nowait()
+            for index, (row_id, chat_id, payload, attempts) in enumerate(chat_rows):
                 try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"🕘 Day {completed_days + 1}/21\n*{habit_name}*\n{goal}\nHow is it going?",
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
+                    await send_with_retry(chat_id, **payload_kwargs(payload))
+                    sent.append(row_id)
+                    continue
                 except Exception as e:
-                    print(f"[ERROR] Failed to send reminder to user {user_id}: {e}")
+                    error = str(e)
+                    sender_log.error("Failed to send message id=%d chat=%d: %s", row_id, chat_id, error)
+
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    failed.append((row_id, error))
+                    continue
+                retry_at = time.time() + retry_delay(attempts) * 10
+                retries.append((row_id, retry_at, error))
+                for later_id, *_ in chat_rows[index + 1:]:
+                    retries.append((later_id, retry_at, "waiting for an earlier message"))
+                break
+
+    await asyncio.gather(*(worker() for _ in range(min(REMINDER_WORKERS, len(by_chat)))))
+    return sent, retries, failed
+
+
+async def outbox_sender():
+    last_cleanup = 0.0
+    while True:
+        try:
+            rows = await db.transaction(claim_outbox, OUTBOX_BATCH)
+        except Exception as e:
+            sender_log.error("Failed to claim outbox messages: %s", e)
+            rows = []
+
+        if rows:
+            started = time.monotonic()
+            sent, retries, failed = await deliver_outbox(rows)
+            # Незаписанные результаты через OUTBOX_CLAIM_TIMEOUT превратятся в повторную
+            # отправку, поэтому запись повторяем несколько раз
+            for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+                try:
+                    await db.transaction(complete_outbox, sent, retries, failed)
+                    break
+                except Exception as e:
+                    sender_log.error("Failed to record outbox results (attempt %d): %s", attempt, e)
+                    await asyncio.sleep(retry_delay(attempt))
+            elapsed = time.monotonic() - started
+            OUTBOX_MESSAGES.inc("sent", amount=len(sent))
+            OUTBOX_MESSAGES.inc("retry", amount=len(retries))
+            OUTBOX_MESSAGES.inc("failed", amount=len(failed))
+            sender_log.info("Delivered sent=%d claimed=%d retries=%d failed=%d elapsed=%.2fs",
+                            len(sent), len(rows), len(retries), len(failed), elapsed)
+
+        if time.time() - last_cleanup > 3600:
+            last_cleanup = time.time()
+            try:
+                await db.execute(
+                    "DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (time.time() - OUTBOX_RETENTION,)
+                )
+            except Exception as e:
+                sender_log.error("Outbox cleanup failed: %s", e)
+
+        if len(rows) < OUTBOX_BATCH:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+# Постановка напоминаний в outbox и перенос next_fire_at на следующий раз — одной
+# транзакцией. Перенос выполняется, только если next_fire_at не поменялся с момента выборки.
+def commit_reminders(conn, rows: list[tuple[str, int, str]], reschedule: list[tuple[int | None, int, int]]) -> int:
+    queued = enqueue_messages(conn, rows)
+    conn.executemany("UPDATE habits SET next_fire_at = ? WHERE id = ? AND next_fire_at = ?", reschedule)
+    return queued
+
+
+# Все наступившие напоминания выбираются одним запросом по индексу next_fire_at.
+# Возвращает число выбранных привычек.
+async def process_due_reminders(now: int) -> int:
+    habits = await db.fetchall("""
+        SELECT h.id, h.user_id, h.habit_name, h.goal, h.next_fire_at, COALESCE(p.total, 0),
+               h.days, h.reminder_time, h.timezone_name, h.timezone_offset
+        FROM habits h
+        LEFT JOIN habit_progress p ON p.habit_id = h.id
+        WHERE h.is_active = 1 AND h.next_fire_at <= ?
+        ORDER BY h.next_fire_at
+        LIMIT ?
+    """, (now, REMINDER_BATCH))
+    if not habits:
+        return 0
+
+    rows = []
+    reschedule = []
+    skipped = 0
+    oldest = now - MAX_CATCHUP_MINUTES * 60
+
+    for habit_id, user_id, habit_name, goal, fire_at, completed_days, *schedule in habits:
+        # Расписание берётся из той же строки, поэтому правки из любого процесса видны сразу
+        reschedule.append((next_fire_at(HabitSlot.from_row(*schedule), now), habit_id, fire_at))
+
+        # Завершённые 21 день привычки закрывает completion_sweeper
+        if completed_days >= 21:
+            continue
+        # Напоминания старше окна догоняния после простоя не отправляем
+        if fire_at < oldest:
+            skipped += 1
+            continue
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="✅ Done", callback_data=f"done:{habit_id}"),
+                InlineKeyboardButton(text="⚠️ Partially", callback_data=f"partial:{habit_id}"),
+                InlineKeyboardButton(text="❌ Missed", callback_data=f"missed:{habit_id}")
+            ]
+        ])
+        rows.append((f"reminder:{habit_id}:{fire_at // 60}", user_id, outbox_payload(
+            f"🕘 Day {completed_days + 1}/21\n*{habit_name}*\n{goal}\nHow is it going?",
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )))
+
+    queued = await db.transaction(commit_reminders, rows, reschedule)
+    if queued:
+        scheduler_log.info("Queued reminders count=%d", queued)
+    if skipped:
+        scheduler_log.warning("Skipped reminders older than the catch-up window count=%d", skipped)
+    return len(habits)
+
+
+# Завершение привычек после 21 дня: все новые завершённые находятся одним запросом,
+# деактивируются и получают поздравления в outbox в одной транзакции. Обработанные
+# строки habit_progress помечаются swept и выпадают из частичного индекса кандидатов.
+def sweep_completed_habits(conn) -> int:
+    candidates = conn.execute("""
+        SELECT p.habit_id, h.user_id, h.habit_name, p.done, p.last_log_day, h.is_active
+        FROM habit_progress p
+        JOIN habits h ON h.id = p.habit_id
+        WHERE p.total >= 21 AND p.swept = 0
+    """).fetchall()
+    if not candidates:
+        return 0
+
+    conn.executemany("UPDATE habit_progress SET swept = 1 WHERE habit_id = ?", [(row[0],) for row in candidates])
+    # Уже неактивные (например, после импорта истории) просто выходят из кандидатов
+    completed = [row[:-1] for row in candidates if row[-1]]
+    if not completed:
+        return 0
+
+    conn.executemany("UPDATE habits SET is_active = 0 WHERE id = ?", [(habit_id,) for habit_id, *_ in completed])
+
+    rows = []
+    for habit_id, user_id, habit_name, done, last_log_day in completed:
+        congrats = static_congrats_message(done)
+        rows.append((f"complete:{habit_id}:{last_log_day}:congrats", user_id, outbox_payload(
+            f"🎉 {congrats}", reply_markup=restart_habit_keyboard([(habit_id, habit_name)])
+        )))
+        # С другими активными привычками остаётся полное меню, перезапуск — кнопкой выше
+        has_active = conn.execute(
+            "SELECT 1 FROM habits WHERE user_id = ? AND is_active = 1 LIMIT 1", (user_id,)
+        ).fetchone()
+        keyboard = main_menu_keyboard if has_active else completed_habit_keyboard
+        rows.append((f"complete:{habit_id}:{last_log_day}:menu", user_id,
+                     outbox_payload("💬 Here's what you can do next:", reply_markup=keyboard)))
+    enqueue_messages(conn, rows)
+    return len(completed)
+
+
+async def completion_sweeper():
+    while True:
+        try:
+            completed = await db.transaction(sweep_completed_habits)
+            if completed:
+                scheduler_log.info("Completed habits count=%d", completed)
+        except Exception as e:
+            scheduler_log.error("Completion sweep failed: %s", e)
+        await asyncio.sleep(COMPLETION_SWEEP_INTERVAL)
+
+
+# Просыпаемся на границе минуты и выбираем привычки, чьё next_fire_at уже наступило.
+# next_fire_at переносится в той же транзакции, что и постановка напоминаний
+# в outbox, поэтому после рестарта пропущенные напоминания догоняются
+# (в пределах MAX_CATCHUP_MINUTES), а уже отправленные не повторяются.
+async def reminder_scheduler():
+    while True:
+        try:
+            await schedule_unscheduled_habits()
+            break
+        except Exception as e:
+            scheduler_log.error("Failed to schedule habits: %s", e)
+            await asyncio.sleep(LEADER_RENEW_INTERVAL)
+
+    while True:
+        try:
+            with SCHEDULER_TICK.timer():
+                while await process_due_reminders(int(time.time())) == REMINDER_BATCH:
+                    pass
+        except Exception as e:
+            scheduler_log.error("Scheduler tick failed: %s", e)
 
-        await asyncio.sleep(60)
+        await asyncio.sleep(60 - time.time() % 60)
+
+
+def format_heatmap(logs: dict[int, str], first_day: int, last_day: int) -> str:
+    cells = [HEATMAP_CELLS.get(logs.get(day), "⬜") for day in range(first_day, last_day + 1)]
+    return "\n".join("".join(cells[i:i + 7]) for i in range(0, len(cells), 7))
+
+
+# Номер сегодняшнего дня по местному календарю привычки; None, если привычки уже нет
+# или она чужая — habit_id приходит из callback_data, и подделанная кнопка не должна
+# попасть в журнал другого пользователя
+async def habit_today(habit_id: int, user_id: int) -> int | None:
+    row = await db.fetchone(
+        "SELECT timezone_name, timezone_offset FROM habits WHERE id = ? AND user_id = ?", (habit_id, user_id)
+    )
+    if row is None:
+        return None
+    return day_number(datetime.now(habit_zone(*row)).date())
+
+
+# Запись в журнал и обновление habit_progress в одной транзакции.
+# Второй лог за тот же день отсекает первичный ключ (habit_id, day).
+def insert_habit_log(conn, user_id: int, habit_id: int, today: int, status: str):
+    inserted = conn.execute("""
+        INSERT INTO habit_logs (habit_id, day, user_id, status)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (habit_id, day) DO NOTHING
+    """, (habit_id, today, user_id, status)).rowcount
+
+    if not inserted:
+        return
+
+    progress = conn.execute(
+        "SELECT last_log_day, current_streak FROM habit_progress WHERE habit_id = ?", (habit_id,)
+    ).fetchone()
+    last_log_day, current_streak = progress or (None, 0)
+    days, = conn.execute("SELECT days FROM habits WHERE id = ?", (habit_id,)).fetchone()
+    streak = next_streak(last_log_day, current_streak, today, status, days_mask(days))
+
+    conn.execute("""
+        INSERT INTO habit_progress (habit_id, user_id, done, partial, missed, total, last_log_day, current_streak,
+                                    longest_streak)
+        VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT(habit_id) DO UPDATE SET
+            done = done + excluded.done,
+            partial = partial + excluded.partial,
+            missed = missed + excluded.missed,
+            total = total + 1,
+            last_log_day = excluded.last_log_day,
+            current_streak = excluded.current_streak,
+            longest_streak = MAX(longest_streak, excluded.current_streak)
+    """, (habit_id, user_id, int(status == "done"), int(status == "partial"), int(status == "missed"), today, streak,
+          streak))
+
+    conn.execute("""
+        INSERT INTO habit_weekday_stats (habit_id, weekday, done, total)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT(habit_id, weekday) DO UPDATE SET
+            done = done + excluded.done,
+            total = total + 1
+    """, (habit_id, day_date(today).weekday(), int(status == "done")))
 
 
 @dp.callback_query(F.data.startswith("done:"))
 async def handle_done(callback: CallbackQuery):
     habit_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
-    today = datetime.now(UTC).strftime("%Y-%m-%d")
-
-    # Проверка: уже есть лог на сегодня?
-    cursor.execute("""
-        SELECT id FROM habit_logs
-        WHERE user_id = ? AND habit_id = ? AND date = ?
-    """, (user_id, habit_id, today))
-    exists = cursor.fetchone()
-
-    if not exists:
-        cursor.execute("""
-            INSERT INTO habit_logs (user_id, habit_id, date, status)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, habit_id, today, "done"))
-        conn.commit()
+    today = await habit_today(habit_id, user_id)
+    if today is None:
+        await callback.answer("This habit no longer exists.")
+        return
+
+    await db.transaction(insert_habit_log, user_id, habit_id, today, "done")
+    motivation_pool.invalidate(habit_id)
 
     await callback.message.edit_text("🎉 Great! I've added it to your journal as 'done'.")
     await callback.answer()
 
 
 @dp.callback_query(F.data.startswith("partial:")) 
-async def handle_done(callback: CallbackQuery):
+async def handle_partial(callback: CallbackQuery):
     habit_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
-    today = datetime.now(UTC).strftime("%Y-%m-%d")
-
-    cursor.execute("""
-        SELECT id FROM habit_logs
-        WHERE user_id = ? AND habit_id = ? AND date = ?
-    """, (user_id, habit_id, today))
-    exists = cursor.fetchone()
+    today = await habit_today(habit_id, user_id)
+    if today is None:
+        await callback.answer("This habit no longer exists.")
+        return
 
-    if not exists:
-        cursor.execute("""
-            INSERT INTO habit_logs (user_id, habit_id, date, status)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, habit_id, today, "partial"))
-        conn.commit()
+    await db.transaction(insert_habit_log, user_id, habit_id, today, "partial")
+    motivation_pool.invalidate(habit_id)
 
     await callback.message.edit_text("👌 Good, partially — it's still a result!")
     await callback.answer()
 
 
 @dp.callback_query(F.data.startswith("missed:")) 
-async def handle_done(callback: CallbackQuery):
+async def handle_missed(callback: CallbackQuery):
     habit_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
-    today = datetime.now(UTC).strftime("%Y-%m-%d")
-
-    cursor.execute("""
-        SELECT id FROM habit_logs
-        WHERE user_id = ? AND habit_id = ? AND date = ?
-    """, (user_id, habit_id, today))
-    exists = cursor.fetchone()
+    today = await habit_today(habit_id, user_id)
+    if today is None:
+        await callback.answer("This habit no longer exists.")
+        return
 
-    if not exists:
-        cursor.execute("""
-            INSERT INTO habit_logs (user_id, habit_id, date, status)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, habit_id, today, "missed"))
-        conn.commit()
+    await db.transaction(insert_habit_log, user_id, habit_id, today, "missed")
+    motivation_pool.invalidate(habit_id)
 
     await callback.message.edit_text("😕 Sad, hope tomorrow will be better!")
     await callback.answer()
 
 
+# Прогресс привычки одним чтением по первичному ключу habit_progress
+async def habit_progress(habit_id: int) -> tuple[int, int, int, int, int]:
+    row = await db.fetchone("""
+        SELECT done, partial, missed, current_streak, longest_streak FROM habit_progress WHERE habit_id = ?
+    """, (habit_id,))
+    return row or (0, 0, 0, 0, 0)
+
+
 @dp.message(F.text == "📈 My Progress")
 async def show_progress(message: Message):
     user_id = message.from_user.id
 
-    cursor.execute("""
-        SELECT id, habit_name FROM habits
-        WHERE user_id = ?
-        ORDER BY id DESC LIMIT 1
-    """, (user_id,))
-    habit_id, habit_name = cursor.fetchone()
-
-    cursor.execute("""
-        SELECT status FROM habit_logs
-        WHERE user_id = ? AND habit_id = ?
-    """, (user_id, habit_id))
-    logs = cursor.fetchall()
+    habit = await user_habits.current(user_id)
+    if not habit:
+        await message.answer("❌ You don't have an active habit.")
+        return
 
-    done = sum(1 for (status,) in logs if status == "done")
-    partial = sum(1 for (status,) in logs if status == "partial")
-    missed = sum(1 for (status,) in logs if status == "missed")
+    habit_id, habit_name = habit.id, habit.habit_name
+    row = await db.fetchone("""
+        SELECT h.days, p.done, p.partial, p.missed, p.current_streak, p.longest_streak, p.last_log_day
+        FROM habits h
+        LEFT JOIN habit_progress p ON p.habit_id = h.id
+        WHERE h.id = ?
+    """, (habit_id,))
+    days, done, partial, missed, streak, longest_streak, last_log_day = row or ("", 0, 0, 0, 0, 0, None)
+    done, partial, missed = done or 0, partial or 0, missed or 0
     total = done + partial + missed
 
+    # Тепловая карта и дни недели — короткие чтения по первичному ключу,
+    # объём не зависит от длины истории привычки
+    today = day_number(datetime.now(habit_zone(habit.timezone_name, habit.timezone_offset)).date())
+    streak = streak_on(today, days_mask(days), last_log_day, streak or 0)
+    longest_streak = longest_streak or 0
+    first_day = today - HEATMAP_DAYS + 1
+    logs = dict(await db.fetchall(
+        "SELECT day, status FROM habit_logs WHERE habit_id = ? AND day BETWEEN ? AND ?", (habit_id, first_day, today)
+    ))
+    weekday_stats = await db.fetchall(
+        "SELECT weekday, done, total FROM habit_weekday_stats WHERE habit_id = ? ORDER BY weekday", (habit_id,)
+    )
+
     text = (
         f"📊 {habit_name}\n"
         f"📅 Day {total}/21\n"
         f"✅ Done: {done}\n"
         f"⚠️ Partial: {partial}\n"
-        f"❌ Missed: {missed}"
+        f"❌ Missed: {missed}\n"
+        f"🔥 Streak: {streak} (best: {longest_streak})\n\n"
+        f"🗓 Last {HEATMAP_DAYS} days:\n{format_heatmap(logs, first_day, today)}"
     )
+    if weekday_stats:
+        text += "\n\n📆 Done by weekday:\n" + "\n".join(
+            f"{WEEKDAYS[weekday][:3]}: {done_count}/{total_count} ({done_count * 100 // total_count}%)"
+            for weekday, done_count, total_count in weekday_stats
+        )
 
     await message.answer(text)
 
@@ -693,34 +2659,38 @@ async def show_progress(message: Message):
 async def show_motivation(message: Message):
     user_id = message.from_user.id
 
-    # Получаем привычку
-    cursor.execute("""
-        SELECT id, habit_name, habit_description, goal FROM habits
-        WHERE user_id = ?
-        ORDER BY id DESC LIMIT 1
-    """, (user_id,))
-    habit = cursor.fetchone()
-
+    # Выбранная привычка из кэша и её прогресс
+    habit = await user_habits.current(user_id)
     if not habit:
         await message.answer("❌ You don't have an active habit.")
         return
 
-    habit_id, habit_name, habit_description, goal = habit
-
-    # Получаем логи
-    cursor.execute("""
-        SELECT status FROM habit_logs
-        WHERE user_id = ? AND habit_id = ?
-    """, (user_id, habit_id))
-    logs = cursor.fetchall()
+    habit_id, habit_name, habit_description, goal = habit.id, habit.habit_name, habit.habit_description, habit.goal
+    done, partial, missed, _, _ = await habit_progress(habit_id)
 
-    done = sum(1 for (status,) in logs if status == "done")
-    partial = sum(1 for (status,) in logs if status == "partial")
-    missed = sum(1 for (status,) in logs if status == "missed")
+    # Сначала готовый пул, затем кэш: тот же прогресс — без запроса к AI
+    cache_key = MotivationCache.make_key(habit_name, habit_description, goal, done, partial, missed)
+    motivation = motivation_pool.take(habit_id, cache_key)
+    if motivation:
+        await motivation_cache.store(cache_key, motivation)
+    else:
+        motivation = motivation_cache.get(cache_key)
+    if motivation:
+        await message.answer(f"🔥 {motivation}")
+        return
 
     # Генерируем мотивацию
     await message.answer("🧠 Thinking of something powerful...")
-    motivation = await generate_motivation(habit_name, habit_description, goal, done, partial, missed)
+    try:
+        motivation = await llm_gate.run(
+            ("motivation", user_id, cache_key),
+            lambda: generate_motivation(habit_name, habit_description, goal, done, partial, missed)
+        )
+    except LLMOverloaded:
+        await message.answer(LLM_OVERLOADED_TEXT)
+        return
+    if not is_ai_error(motivation):
+        await motivation_cache.store(cache_key, motivation)
 
     await message.answer(f"🔥 {motivation}")
 
@@ -736,36 +2706,83 @@ async def handle_ai_chat(message: Message, state: FSMContext):
     user_id = message.from_user.id
     user_question = message.text
 
-    # Получаем активную привычку
-    cursor.execute("""
-        SELECT id, habit_name, habit_description, goal FROM habits
-        WHERE user_id = ? ORDER BY id DESC LIMIT 1
-    """, (user_id,))
-    habit = cursor.fetchone()
-
+    # Выбранная привычка из кэша и её прогресс
+    habit = await user_habits.current(user_id)
     if not habit:
         await message.answer("❌ You don't have an active habit.")
         await state.clear()
         return
 
-    habit_id, habit_name, description, goal = habit
+    habit_name, description, goal = habit.habit_name, habit.habit_description, habit.goal
+    done, partial, missed, _, _ = await habit_progress(habit.id)
+
+    # Память разговора переживает рестарт и смену воркера
+    memory = chat_memory(state, habit.id)
+    data = await memory.get_data()
+    history = data.get("chat_history", [])
+    summary = data.get("chat_summary")
+
+    placeholder = await message.answer("💬 Thinking...")
+
+    def full_response():
+        return llm_gate.run(
+            ("advice", user_id, user_question),
+            lambda: generate_ai_advice(habit_name, description, goal, done, partial, missed, user_question, history, summary)
+        )
+
+    try:
+        if AI_STREAMING:
+            try:
+                async with llm_gate.slot():
+                    response = await stream_to_message(
+                        placeholder,
+                        stream_ai_advice(habit_name, description, goal, done, partial, missed, user_question, history, summary)
+                    )
+            except LLMOverloaded:
+                raise
+            except Exception as e:
+                llm_log.warning("AI streaming failed, falling back to a full response: %s", e)
+                response = await full_response()
+                await placeholder.edit_text(response)
+        else:
+            response = await full_response()
+            await message.answer(response)
+    except LLMOverloaded:
+        await placeholder.edit_text(LLM_OVERLOADED_TEXT)
+        return
+
+    if not is_ai_error(response):
+        await remember_chat_turn(memory, user_id, history, summary, user_question, response)
 
-    # Прогресс
-    cursor.execute("""
-        SELECT status FROM habit_logs
-        WHERE user_id = ? AND habit_id = ?
-    """, (user_id, habit_id))
-    logs = cursor.fetchall()
 
-    done = sum(1 for (status,) in logs if status == "done")
-    partial = sum(1 for (status,) in logs if status == "partial")
-    missed = sum(1 for (status,) in logs if status == "missed")
+# Память чата — отдельная запись FSM со своим destiny на каждую привычку: state.clear()
+# в мастере и меню её не стирает, а после смены привычки разговоры не смешиваются
+def chat_memory(state: FSMContext, habit_id: int) -> FSMContext:
+    return FSMContext(storage=state.storage, key=replace(state.key, destiny=f"chat:{habit_id}"))
 
-    await message.answer("💬 Thinking...")
 
-    response = await generate_ai_advice(habit_name, description, goal, done, partial, missed, user_question)
+def chat_memory_pattern(user_id: int, habit_id: int) -> str:
+    return f"%:{user_id}:%:chat:{habit_id}"
 
-    await message.answer(response) 
+
+# Добавляем реплики в буфер; вытесненные сворачиваются в краткое содержание.
+# Если AI недоступен, прежнее содержание сохраняется, а вытесненное теряется —
+# размер памяти важнее её полноты.
+async def remember_chat_turn(state: FSMContext, user_id: int, history: list, summary: str | None,
+                             question: str, answer: str):
+    history, evicted = trim_chat_history(history + [
+        ["user", question, estimate_tokens(question)],
+        ["assistant", answer, estimate_tokens(answer)],
+    ])
+    if evicted:
+        try:
+            summary = await llm_gate.run(
+                ("chat_summary", user_id, tuple(content for _, content, _ in evicted)),
+                lambda: summarize_chat(summary, evicted)
+            ) or summary
+        except LLMOverloaded:
+            pass
+    await state.update_data(chat_history=history, chat_summary=summary)
 
 
 @dp.message(HabitStates.AI_CHAT, F.text == "🔙 Back")
@@ -774,26 +2791,82 @@ async def exit_ai_chat(message: Message, state: FSMContext):
     await state.clear()
 
 
+# Переключение между активными привычками
+@dp.message(F.text == "🔀 Switch Habit")
+async def switch_habit(message: Message):
+    user_id = message.from_user.id
+    habits = await user_habits.active(user_id)
+    if not habits:
+        await message.answer("❌ You don't have an active habit.")
+        return
+
+    current = await user_habits.current(user_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=("✅ " if habit.id == current.id else "") + habit.habit_name,
+            callback_data=f"select_habit:{habit.id}"
+        )]
+        for habit in habits
+    ])
+    await message.answer("🔀 Choose a habit:", reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("select_habit:"))
+async def select_habit(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    habit = await user_habits.find(user_id, int(callback.data.split(":")[1]))
+    if habit is None or not habit.is_active:
+        await callback.answer("This habit is no longer active.", show_alert=True)
+        return
+
+    await user_habits.select(user_id, habit.id)
+    await callback.message.edit_text(f"👉 Now showing: {habit.habit_name}")
+    await callback.answer()
+
+
 @dp.message(F.text == "❌ Cancel Habit")
 async def cancel_habit(message: Message, state: FSMContext):
-    await message.answer("Are you sure you want to cancel your habit?", reply_markup=cancel_habit_keyboard)
-    
+    habit = await user_habits.current(message.from_user.id)
+    if not habit:
+        await message.answer("❌ You don't have an active habit.")
+        return
+
+    await state.update_data(cancel_habit_id=habit.id)
+    await message.answer(f"Are you sure you want to cancel your habit \"{habit.habit_name}\"?", reply_markup=cancel_habit_keyboard)
+
     await state.set_state(HabitStates.CONFIRM_CANCEL)
 
+def delete_habit(conn, user_id: int, habit_id: int) -> bool:
+    deleted = conn.execute("DELETE FROM habits WHERE id = ? AND user_id = ?", (habit_id, user_id)).rowcount
+    if not deleted:
+        return False
+    conn.execute("DELETE FROM habit_logs WHERE habit_id = ?", (habit_id,))
+    conn.execute("DELETE FROM habit_progress WHERE habit_id = ?", (habit_id,))
+    conn.execute("DELETE FROM habit_weekday_stats WHERE habit_id = ?", (habit_id,))
+    conn.execute("DELETE FROM fsm_storage WHERE storage_key LIKE ?", (chat_memory_pattern(user_id, habit_id),))
+    return True
+
+
 @dp.callback_query(F.data == "confirm_cancel_habit", HabitStates.CONFIRM_CANCEL)
 async def confirm_cancel(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    cursor.execute("DELETE FROM habits WHERE user_id = ?", (user_id,))
-    cursor.execute("DELETE FROM habit_logs WHERE user_id = ?", (user_id,))
-    conn.commit()
-    
+    data = await state.get_data()
+    habit_id = data.get("cancel_habit_id")
+    if habit_id is not None and await db.transaction(delete_habit, user_id, habit_id):
+        motivation_pool.invalidate(habit_id)
+    user_habits.invalidate(user_id)
+    await state.clear()
+
     await callback.message.edit_text("Your habit has been canceled.")
+    if await user_habits.active(user_id):
+        await callback.message.answer("💬 Here's what you can do next:", reply_markup=main_menu_keyboard)
+        return
+
     await callback.message.answer("Have a good day!", reply_markup=ReplyKeyboardRemove())
     await callback.message.answer(
         "Want to start a new journey?",
         reply_markup=get_start_keyboard()
     )
-    await state.clear()
 
 @dp.callback_query(F.data == "cancel_cancel_habit", HabitStates.CONFIRM_CANCEL)
 async def cancel_cancel(callback: CallbackQuery, state: FSMContext):
@@ -802,26 +2875,58 @@ async def cancel_cancel(callback: CallbackQuery, state: FSMContext):
     await state.clear()
 
 
+def restart_habit(conn, habit_id: int, user_id: int):
+    days, reminder_time, timezone_name, timezone_offset = conn.execute(
+        "SELECT days, reminder_time, timezone_name, timezone_offset FROM habits WHERE id = ?", (habit_id,)
+    ).fetchone()
+    slot = HabitSlot.from_row(days, reminder_time, timezone_name, timezone_offset)
+    conn.execute(
+        "UPDATE habits SET is_active = 1, next_fire_at = ? WHERE id = ?", (next_fire_at(slot, int(time.time())), habit_id)
+    )
+    conn.execute("DELETE FROM habit_logs WHERE habit_id = ? AND user_id = ?", (habit_id, user_id))
+    conn.execute("DELETE FROM habit_progress WHERE habit_id = ?", (habit_id,))
+    conn.execute("DELETE FROM habit_weekday_stats WHERE habit_id = ?", (habit_id,))
+
+
+async def restart_user_habit(message: Message, user_id: int, habit_id: int):
+    await db.transaction(restart_habit, habit_id, user_id)
+    motivation_pool.invalidate(habit_id)
+    await user_habits.select(user_id, habit_id)
+    await message.answer("🔁 Your habit has been restarted! Let’s go again! 💪", reply_markup=main_menu_keyboard)
+
+
+# Кнопка меню: единственную завершённую привычку перезапускаем сразу,
+# из нескольких пользователь выбирает сам
 @dp.message(F.text == "🔁 Restart Habit")
 async def handle_restart_habit(message: Message):
     user_id = message.from_user.id
 
-    cursor.execute("""
-        SELECT id FROM habits 
+    completed = await db.fetchall("""
+        SELECT id, habit_name FROM habits
         WHERE user_id = ? AND is_active = 0
-        ORDER BY id DESC LIMIT 1
+        ORDER BY id DESC
     """, (user_id,))
-    result = cursor.fetchone()
-
-    if result:
-        habit_id = result[0]
-        cursor.execute("UPDATE habits SET is_active = 1 WHERE id = ?", (habit_id,))
-        cursor.execute("DELETE FROM habit_logs WHERE habit_id = ? AND user_id = ?", (habit_id, user_id))
-        conn.commit()
 
-        await message.answer("🔁 Your habit has been restarted! Let’s go again! 💪", reply_markup=main_menu_keyboard)
-    else:
+    if not completed:
         await message.answer("⚠️ No completed habit found to restart.")
+    elif len(completed) == 1:
+        await restart_user_habit(message, user_id, completed[0][0])
+    else:
+        await message.answer("🔁 Which habit do you want to restart?", reply_markup=restart_habit_keyboard(completed))
+
+
+@dp.callback_query(F.data.startswith("restart_habit:"))
+async def restart_habit_callback(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    habit_id = int(callback.data.split(":")[1])
+    row = await db.fetchone("SELECT is_active FROM habits WHERE id = ? AND user_id = ?", (habit_id, user_id))
+    if row is None or row[0]:
+        await callback.answer("This habit can't be restarted.", show_alert=True)
+        return
+
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await restart_user_habit(callback.message, user_id, habit_id)
+    await callback.answer()
 
 
 @dp.message(F.text == "🆕 New Habit")
@@ -833,13 +2938,284 @@ async def handle_new_habit(message: Message, state: FSMContext):
 
 
 
+# Аренда лидера: строка в scheduler_lock, которую владелец продлевает каждые
+# LEADER_RENEW_INTERVAL секунд. Если владелец пропал, через LEADER_LEASE_TTL её забирает другой.
+def acquire_lease(conn, name: str, owner: str, ttl: float) -> bool:
+    now = time.time()
+    return conn.execute("""
+        INSERT INTO scheduler_lock (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE scheduler_lock.owner = excluded.owner OR scheduler_lock.expires_at < ?
+    """, (name, owner, now + ttl, now)).rowcount == 1
+
+
+def release_lease(conn, name: str, owner: str):
+    conn.execute("DELETE FROM scheduler_lock WHERE name = ? AND owner = ?", (name, owner))
+
+
+# Каждая фоновая задача работает под своей арендой — ровно в одном процессе
+BACKGROUND_JOBS = {
+    "scheduler": reminder_scheduler,
+    "completion_sweep": completion_sweeper,
+    "sender": outbox_sender,
+}
+
+
+async def leader_loop(name: str, job):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    task: asyncio.Task | None = None
+    try:
+        while True:
+            try:
+                leader = await db.transaction(acquire_lease, name, owner, LEADER_LEASE_TTL)
+            except Exception as e:
+                bot_log.error("Failed to renew %s lease: %s", name, e)
+                leader = False
+
+            # Упавшая задача перезапускается при следующем продлении, иначе процесс
+            # держал бы аренду, ничего не делая, и другие воркеры её бы не забрали
+            if task is not None and task.done():
+                error = None if task.cancelled() else task.exception()
+                bot_log.error("%s stopped unexpectedly, restarting: %r", name, error, exc_info=error)
+                task = None
+
+            if leader and task is None:
+                bot_log.info("%s is running %s", owner, name)
+                task = asyncio.create_task(job())
+            elif not leader and task is not None:
+                bot_log.warning("%s lost the %s lease", owner, name)
+                task.cancel()
+                task = None
+
+            await asyncio.sleep(LEADER_RENEW_INTERVAL)
+    finally:
+        if task is not None:
+            task.cancel()
+            await db.transaction(release_lease, name, owner)
+
+
+background_tasks: list[asyncio.Task] = []
+
+
+def start_background_jobs(names):
+    for name in names:
+        background_tasks.append(asyncio.create_task(leader_loop(name, BACKGROUND_JOBS[name])))
+
+
+async def stop_background_jobs():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+
+async def on_startup():
+    await motivation_cache.load()
+    get_http_client()
+    # Пул мотиваций — кэш процесса: его читает только тот воркер, что получил апдейт.
+    # С несколькими воркерами он выключен (см. run_webhook), иначе бюджет LLM тратился бы N раз
+    if motivation_pool.max_habits > 0:
+        background_tasks.append(asyncio.create_task(motivation_pool_worker()))
+    if RUN_BACKGROUND_JOBS:
+        start_background_jobs(BACKGROUND_JOBS)
+
+
+async def on_shutdown():
+    await stop_background_jobs()
+    bot_log.info("Motivation cache: %s", motivation_cache.stats())
+    await fsm_storage.close()
+    await close_http_client()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+# Время и ошибки каждого хэндлера, подписанные именем его функции
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render_metrics().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Локальный HTTP-эндпоинт /metrics для Prometheus; port 0 — выключен
+async def start_metrics_server(port: int) -> web.AppRunner | None:
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    bot_log.info("Metrics available at http://%s:%d/metrics", METRICS_HOST, port)
+    return runner
+
+
+# Отдельный процесс только с фоновыми задачами: планировщик ставит напоминания
+# в outbox, отправитель их рассылает, обработка апдейтов их не ждёт
+async def run_jobs(names: list[str]):
+    bot_log.info("Background jobs started: %s", ", ".join(names))
+    get_http_client()
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    start_background_jobs(names)
+    try:
+        await asyncio.gather(*background_tasks)
+    finally:
+        await stop_background_jobs()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_http_client()
+        await bot.session.close()
+        db.close()
+
+
 async def main():
-    print("Bot started...")
-    asyncio.create_task(reminder_scheduler())
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    bot_log.info("Bot started...")
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        db.close()
+
+
+# Один воркер webhook-сервера. При нескольких воркерах порт общий (SO_REUSEPORT),
+# апдейты распределяет ядро, а фоновые задачи берёт только лидер.
+async def run_webhook_worker(worker_id: int, reuse_port: bool):
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=reuse_port)
+    await site.start()
+    bot_log.info("Webhook worker %d (pid %d) listening on %s:%d%s",
+                 worker_id, os.getpid(), WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    # У каждого воркера свои метрики, поэтому и свой порт
+    metrics_runner = await start_metrics_server(METRICS_PORT + worker_id if METRICS_PORT else 0)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await runner.cleanup()
+        db.close()
 
-if __name__ == "__main__":
-    asyncio.run(main())
+
+def webhook_worker_process(worker_id: int, reuse_port: bool = False):
+    try:
+        asyncio.run(run_webhook_worker(worker_id, reuse_port))
+    except KeyboardInterrupt:
+        pass
 
 
+async def register_webhook():
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True
+        )
+        bot_log.info("Webhook set to %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+    finally:
+        await bot.session.close()
+
+
+def run_webhook(workers: int):
+    # Без WEBHOOK_URL вебхук не регистрируется — удобно для локальной отправки апдейтов
+    if WEBHOOK_URL:
+        asyncio.run(register_webhook())
+
+    if workers <= 1:
+        webhook_worker_process(0)
+        return
+
+    # Апдейты одного пользователя попадают в разные воркеры: состояние FSM
+    # и выбранную привычку читаем из базы каждый раз, FSM записываем до ответа на апдейт
+    fsm_storage.cache_ttl = 0
+    fsm_storage.flush_delay = 0
+    user_habits.ttl = 0
+    # Пул мотиваций наполнялся бы в каждом воркере, а попадал в него лишь каждый N-й апдейт
+    motivation_pool.max_habits = 0
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=webhook_worker_process, args=(i, True)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+# Выгрузка и загрузка истории из командной строки, без запуска бота
+async def run_export(path: str, export_format: str, user_id: int | None):
+    try:
+        count = await db.read(write_export, path, export_format, user_id)
+        db_log.info("Exported %d records to %s", count, path)
+    finally:
+        await bot.session.close()
+        db.close()
+
+
+async def run_import(path: str, export_format: str):
+    try:
+        habits, logs, skipped_habits, skipped_logs = await import_export_file(path, export_format)
+        db_log.info("Imported %d habits and %d logs from %s", habits, logs, path)
+        if skipped_habits or skipped_logs:
+            db_log.warning("Skipped %d habits with ids taken by other users and %d logs without a matching habit",
+                           skipped_habits, skipped_logs)
+    finally:
+        await bot.session.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="21Day habit bot")
+    parser.add_argument("mode", nargs="?", choices=["polling", "webhook", "scheduler", "sender", "export", "import"],
+                        default="polling")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS, help="webhook worker processes")
+    parser.add_argument("--file", help="export/import: file to write or read")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="export/import: file format (default: by extension)")
+    parser.add_argument("--user", type=int, help="export: only this user's habits (default: the whole database)")
+    args = parser.parse_args()
+
+    if args.mode in ("export", "import"):
+        if not args.file:
+            parser.error(f"{args.mode} needs --file")
+        export_format = args.format or ("jsonl" if args.file.endswith(".jsonl") else "csv")
+
+    if args.mode == "export":
+        asyncio.run(run_export(args.file, export_format, args.user))
+    elif args.mode == "import":
+        asyncio.run(run_import(args.file, export_format))
+    elif args.mode == "webhook":
+        run_webhook(args.workers)
+    elif args.mode == "scheduler":
+        # Пул мотиваций живёт в памяти процесса бота, здесь его некому читать
+        asyncio.run(run_jobs(["scheduler", "completion_sweep"]))
+    elif args.mode == "sender":
+        asyncio.run(run_jobs(["sender"]))
+    else:
+        asyncio.run(main())
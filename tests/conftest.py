@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import tempfile
+import types
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+# main.py читает настройки при импорте: отдельная база и фиктивный токен
+os.environ["BOT_TOKEN"] = "123456:TEST"
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="habit-tests-"), "habits.db")
+os.environ["TOGETHER_API_KEY"] = "test"
+os.environ["MOTIVATION_CACHE_PERSIST"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+# Каждый тест идёт в своём event loop: HTTP-клиент, лимитер и шлюз LLM создаются заново
+@pytest.fixture
+def run(monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.TelegramRateLimiter(1000, 1000))
+    monkeypatch.setattr(main, "llm_gate", main.LLMGate(4, 10))
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 1)
+
+    def run(coro):
+        async def wrapped():
+            try:
+                return await coro
+            finally:
+                await main.close_http_client()
+        return asyncio.run(wrapped())
+    return run
+
+
+# Локальный chat/completions: handler(request, body) -> web.StreamResponse
+@pytest.fixture
+def llm_server(monkeypatch):
+    @asynccontextmanager
+    async def serve(handler):
+        async def endpoint(request):
+            return await handler(request, await request.json())
+
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", endpoint)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(main, "TOGETHER_API_URL", f"http://127.0.0.1:{port}/v1/chat/completions")
+        try:
+            yield
+        finally:
+            await runner.cleanup()
+    return serve
+
+
+# Ответ SSE из кусков текста, с паузой между ними
+async def sse_response(request, chunks, delay=0.0, usage=None):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for chunk in chunks:
+        await response.write(f"data: {main.json.dumps({'choices': [{'delta': {'content': chunk}}]})}\n\n".encode())
+        await asyncio.sleep(delay)
+    if usage:
+        await response.write(f"data: {main.json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def completion_response(text, usage=None):
+    return web.json_response({"choices": [{"message": {"content": text}}], "usage": usage or {}})
+
+
+# Сообщение Telegram без сети: запоминает ответы и правки
+class FakeMessage:
+    def __init__(self, user_id=1, text=""):
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.chat = types.SimpleNamespace(id=user_id)
+        self.text = text
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+        reply = FakeMessage(self.from_user.id)
+        reply.edits = self.edits
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+        return self
+
+
+class FakeState:
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.state = None
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+        return dict(self.data)
+
+    async def set_state(self, state=None):
+        self.state = state
+
+    async def clear(self):
+        self.data, self.state = {}, None
@@ -0,0 +1,114 @@
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiohttp import web
+
+import main
+from conftest import FakeState, completion_response
+
+
+def turn(role, text):
+    return [role, text, main.estimate_tokens(text)]
+
+
+def test_trim_chat_history_keeps_turn_limit(monkeypatch):
+    monkeypatch.setattr(main, "CHAT_HISTORY_TURNS", 4)
+    history = [turn("user" if i % 2 == 0 else "assistant", f"message {i}") for i in range(10)]
+
+    kept, evicted = main.trim_chat_history(history)
+
+    assert kept == history[6:]
+    assert evicted == history[:6]
+
+
+def test_trim_chat_history_keeps_token_budget(monkeypatch):
+    monkeypatch.setattr(main, "CHAT_HISTORY_TURNS", 100)
+    monkeypatch.setattr(main, "CHAT_HISTORY_TOKENS", 100)
+    history = [turn("user" if i % 2 == 0 else "assistant", "x" * 120) for i in range(8)]
+
+    kept, evicted = main.trim_chat_history(history)
+
+    assert sum(count for *_, count in kept) <= 100
+    # Вытесняются целые пары вопрос-ответ, старые первыми
+    assert len(evicted) % 2 == 0
+    assert kept == history[len(evicted):]
+
+
+def test_remember_chat_turn_summarizes_evicted_turns(run, llm_server, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_HISTORY_TURNS", 4)
+    prompts = []
+
+    async def handler(request, body):
+        prompts.append(body["messages"][-1]["content"])
+        return completion_response("User runs daily and struggles on Mondays.")
+
+    async def scenario():
+        state = FakeState()
+        history, summary = [], None
+        async with llm_server(handler):
+            for i in range(4):
+                await main.remember_chat_turn(state, 1, history, summary, f"question {i}", f"answer {i}")
+                history, summary = state.data["chat_history"], state.data["chat_summary"]
+        return state.data
+
+    data = run(scenario())
+    assert [content for _, content, _ in data["chat_history"]] == ["question 2", "answer 2", "question 3", "answer 3"]
+    assert data["chat_summary"] == "User runs daily and struggles on Mondays."
+    # Первое сворачивание — без прежнего содержания, следующее получает его
+    assert len(prompts) == 2
+    assert "Previous summary: none" in prompts[0] and "question 0" in prompts[0]
+    assert "struggles on Mondays" in prompts[1] and "question 1" in prompts[1]
+
+
+def test_remember_chat_turn_keeps_old_summary_when_ai_fails(run, llm_server, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_HISTORY_TURNS", 2)
+
+    async def handler(request, body):
+        return web.json_response({"error": {"message": "bad request"}}, status=400)
+
+    async def scenario():
+        state = FakeState()
+        history = [turn("user", "old question"), turn("assistant", "old answer")]
+        async with llm_server(handler):
+            await main.remember_chat_turn(state, 1, history, "Earlier summary", "new question", "new answer")
+        return state.data
+
+    data = run(scenario())
+    assert data["chat_summary"] == "Earlier summary"
+    assert [content for _, content, _ in data["chat_history"]] == ["new question", "new answer"]
+
+
+def test_ai_advice_messages_include_summary_and_history():
+    history = [turn("user", "How do I start?"), turn("assistant", "Start small.")]
+
+    messages = main.ai_advice_messages("Run", "Daily run", "5 km", 3, 1, 0, "And now?", history, "Likes mornings")
+
+    assert messages[1] == {"role": "system", "content": "Summary of the earlier conversation: Likes mornings"}
+    assert messages[2:4] == [{"role": "user", "content": "How do I start?"},
+                             {"role": "assistant", "content": "Start small."}]
+    assert messages[-1]["role"] == "user"
+
+
+def test_chat_memory_survives_state_clear_and_is_per_habit(run):
+    async def scenario():
+        storage = main.SQLiteStorage(main.db, 60, 0.01, 100)
+        state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=970, user_id=970))
+        first = await main.db.transaction(main.create_habit, 970, "health", "Run", "d", "g", "Monday", 0, "07:00")
+        second = await main.db.transaction(main.create_habit, 970, "health", "Read", "d", "g", "Monday", 0, "07:00")
+
+        await main.chat_memory(state, first).update_data(chat_history=[turn("user", "about running")])
+        await state.clear()
+        kept = await main.chat_memory(state, first).get_data()
+        other = await main.chat_memory(state, second).get_data()
+
+        await storage.flush()
+        await main.db.transaction(main.delete_habit, 970, first)
+        await main.db.transaction(main.delete_habit, 970, second)
+        rows = await main.db.fetchone("SELECT COUNT(*) FROM fsm_storage WHERE storage_key LIKE '%:970:%'")
+        await storage.close()
+        return kept, other, rows
+
+    kept, other, rows = run(scenario())
+    assert [content for _, content, _ in kept["chat_history"]] == ["about running"]
+    assert other == {}
+    # Удаление привычки стирает и её память
+    assert rows == (0,)
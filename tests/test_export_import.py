@@ -0,0 +1,79 @@
+import main
+
+
+def habit_record(habit_id, user_id, **fields):
+    return {"record": "habit", "habit_id": habit_id, "user_id": user_id, "category": "health",
+            "habit_name": "Run", "habit_description": "d", "goal": "g", "days": "Monday,Thursday",
+            "timezone_offset": 5.5, "timezone_name": "Asia/Kolkata", "reminder_time": "07:00", "is_active": 1,
+            **fields}
+
+
+def log_record(habit_id, user_id, day, status="done"):
+    return {"record": "log", "habit_id": habit_id, "user_id": user_id, "date": day, "status": status}
+
+
+async def cleanup(*habit_ids):
+    for habit_id in habit_ids:
+        await main.db.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+        await main.db.execute("DELETE FROM habit_logs WHERE habit_id = ?", (habit_id,))
+        await main.db.execute("DELETE FROM habit_progress WHERE habit_id = ?", (habit_id,))
+        await main.db.execute("DELETE FROM habit_weekday_stats WHERE habit_id = ?", (habit_id,))
+
+
+def test_import_is_idempotent_and_rebuilds_progress(run):
+    records = [habit_record(5001, 980), log_record(5001, 980, "2024-01-01"), log_record(5001, 980, "2024-01-04")]
+
+    async def scenario():
+        first = await main.db.transaction(main.import_records, records)
+        again = await main.db.transaction(main.import_records, records)
+        progress = await main.db.fetchone("SELECT done, total FROM habit_progress WHERE habit_id = 5001")
+        await cleanup(5001)
+        return first, again, progress
+
+    first, again, progress = run(scenario())
+    assert first == (1, 2, [], 0)
+    assert again == (0, 0, [], 0)
+    assert progress == (2, 2)
+
+
+def test_import_skips_habits_and_logs_owned_by_other_users(run):
+    async def scenario():
+        await main.db.transaction(main.import_records, [habit_record(5002, 981, habit_name="Theirs")])
+        result = await main.db.transaction(main.import_records, [
+            habit_record(5002, 980),
+            log_record(5002, 980, "2024-01-01"),
+            # Лог с чужим user_id для существующей привычки тоже не принимается
+            log_record(5002, 982, "2024-01-02"),
+        ])
+        habit = await main.db.fetchone("SELECT user_id, habit_name FROM habits WHERE id = 5002")
+        logs = await main.db.fetchone("SELECT COUNT(*) FROM habit_logs WHERE habit_id = 5002")
+        await cleanup(5002)
+        return result, habit, logs
+
+    result, habit, logs = run(scenario())
+    assert result == (0, 0, [5002], 2)
+    assert habit == (981, "Theirs")
+    assert logs == (0,)
+
+
+def test_export_round_trip(run, tmp_path):
+    path = str(tmp_path / "export.csv")
+    records = [habit_record(5003, 983), log_record(5003, 983, "2024-01-01", "partial")]
+
+    async def scenario():
+        await main.db.transaction(main.import_records, records)
+        exported = await main.db.read(main.write_export, path, "csv", 983)
+        await cleanup(5003)
+        imported = await main.import_export_file(path, "csv")
+        habit = await main.db.fetchone(
+            "SELECT user_id, days, timezone_offset, timezone_name, next_fire_at IS NOT NULL FROM habits WHERE id = 5003"
+        )
+        log = await main.db.fetchone("SELECT day, status FROM habit_logs WHERE habit_id = 5003")
+        await cleanup(5003)
+        return exported, imported, habit, log
+
+    exported, imported, habit, log = run(scenario())
+    assert exported == 2
+    assert imported == (1, 1, 0, 0)
+    assert habit == (983, "Monday,Thursday", 5.5, "Asia/Kolkata", 1)
+    assert log == (main.day_number(main.date(2024, 1, 1)), "partial")
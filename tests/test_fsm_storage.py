@@ -0,0 +1,116 @@
+from aiogram.fsm.storage.base import StorageKey
+
+import main
+
+KEY = StorageKey(bot_id=1, chat_id=960, user_id=960)
+
+
+def storage(flush_delay=0.01):
+    return main.SQLiteStorage(main.db, cache_ttl=60, flush_delay=flush_delay, cache_size=100)
+
+
+async def stored_row():
+    return await main.db.fetchone(
+        "SELECT data, version FROM fsm_storage WHERE storage_key = ?", (main.SQLiteStorage._key(KEY),)
+    )
+
+
+async def cleanup(*storages):
+    for item in storages:
+        await item.close()
+    await main.db.execute("DELETE FROM fsm_storage WHERE storage_key = ?", (main.SQLiteStorage._key(KEY),))
+
+
+def test_write_record_checks_the_version(run):
+    storage_key = main.SQLiteStorage._key(KEY)
+    write = main.SQLiteStorage._write_record
+
+    async def scenario():
+        results = [
+            await main.db.transaction(write, storage_key, None, '{"step": 1}', 0),
+            # Вторая вставка с нуля и запись по устаревшей версии — конфликты
+            await main.db.transaction(write, storage_key, None, '{"step": 2}', 0),
+            await main.db.transaction(write, storage_key, None, '{"step": 2}', 1),
+            await main.db.transaction(write, storage_key, None, '{"step": 3}', 1),
+        ]
+        row = await stored_row()
+        deleted = await main.db.transaction(write, storage_key, None, None, 1), \
+            await main.db.transaction(write, storage_key, None, None, 2)
+        return results, row, deleted, await stored_row()
+
+    results, row, deleted, after = run(scenario())
+    assert results == [1, None, 2, None]
+    assert row == ('{"step": 2}', 2)
+    assert deleted == (None, 0)
+    assert after is None
+
+
+def test_stale_write_is_dropped_and_reloaded(run):
+    async def scenario():
+        first, second = storage(), storage()
+        await first.set_data(KEY, {"days": ["Monday"]})
+        await first.flush()
+        await second.get_data(KEY)
+
+        await second.set_data(KEY, {"days": ["Monday", "Tuesday"]})
+        await second.flush()
+        # У первого процесса в кэше версия 1: его запись конфликтует и не перетирает вторую
+        await first.set_data(KEY, {"days": ["Monday", "Wednesday"]})
+        await first.flush()
+        result = await first.get_data(KEY), await stored_row(), first.dirty
+        await cleanup(first, second)
+        return result
+
+    data, row, dirty = run(scenario())
+    assert data == {"days": ["Monday", "Tuesday"]}
+    assert row == ('{"days": ["Monday", "Tuesday"]}', 2)
+    assert dirty == {}
+
+
+def test_changes_during_a_flush_stay_dirty(run):
+    async def scenario():
+        item = storage()
+        await item.set_data(KEY, {"step": 1})
+        flush = main.asyncio.create_task(item.flush())
+        await main.asyncio.sleep(0)
+        await item.set_data(KEY, {"step": 2})
+        await flush
+        dirty_after_first = dict(item.dirty)
+        await item.flush()
+        result = dirty_after_first, await stored_row(), item.dirty
+        await cleanup(item)
+        return result
+
+    dirty_after_first, row, dirty = run(scenario())
+    assert list(dirty_after_first) == [main.SQLiteStorage._key(KEY)]
+    assert row == ('{"step": 2}', 2)
+    assert dirty == {}
+
+
+def test_cleared_record_is_deleted(run):
+    async def scenario():
+        item = storage()
+        await item.set_data(KEY, {"step": 1})
+        await item.flush()
+        await item.set_data(KEY, {})
+        await item.flush()
+        row = await stored_row()
+        await cleanup(item)
+        return row
+
+    assert run(scenario()) is None
+
+
+def test_without_flush_delay_writes_commit_before_returning(run):
+    async def scenario():
+        item = storage(flush_delay=0)
+        await item.set_state(KEY, "HabitStates:ENTER_HABIT_NAME")
+        row = await main.db.fetchone(
+            "SELECT state FROM fsm_storage WHERE storage_key = ?", (main.SQLiteStorage._key(KEY),)
+        )
+        await cleanup(item)
+        return row, item.dirty
+
+    row, dirty = run(scenario())
+    assert row == ("HabitStates:ENTER_HABIT_NAME",)
+    assert dirty == {}
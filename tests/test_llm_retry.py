@@ -0,0 +1,67 @@
+import time
+
+from aiohttp import web
+
+import main
+from conftest import completion_response
+
+
+def test_post_chat_completion_retries_short_retry_after(run, llm_server):
+    statuses = [429]
+
+    async def handler(request, body):
+        if statuses:
+            statuses.pop()
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"Retry-After": "0"})
+        return completion_response("ok")
+
+    async def scenario():
+        async with llm_server(handler):
+            return await main.post_chat_completion({"messages": []})
+
+    assert run(scenario())["choices"][0]["message"]["content"] == "ok"
+
+
+def test_post_chat_completion_gives_up_on_long_retry_after(run, llm_server):
+    async def handler(request, body):
+        return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"Retry-After": "3600"})
+
+    async def scenario():
+        async with llm_server(handler):
+            started = time.monotonic()
+            data = await main.post_chat_completion({"messages": []})
+            return data, time.monotonic() - started
+
+    data, elapsed = run(scenario())
+    assert data["error"]["message"] == "rate limited"
+    assert elapsed < 1
+
+
+def test_llm_gate_counts_coalesced_and_shed_requests(run):
+    gate = main.LLMGate(1, 0)
+    release = None
+
+    async def slow():
+        await release.wait()
+        return "ok"
+
+    async def scenario():
+        nonlocal release
+        release = main.asyncio.Event()
+        first = main.asyncio.ensure_future(gate.run(("a",), slow))
+        same = main.asyncio.ensure_future(gate.run(("a",), slow))
+        # Ждём, пока первый запрос займёт единственный слот
+        while gate.is_idle():
+            await main.asyncio.sleep(0)
+        try:
+            await gate.run(("b",), slow)
+        except main.LLMOverloaded:
+            pass
+        release.set()
+        return await first, await same
+
+    coalesced, shed = main.LLM_COALESCED.values.get((), 0), main.LLM_SHED.values.get((), 0)
+    assert run(scenario()) == ("ok", "ok")
+    assert main.LLM_COALESCED.values[()] == coalesced + 1
+    assert main.LLM_SHED.values[()] == shed + 1
+    assert "llm_requests_shed_total" in main.render_metrics()
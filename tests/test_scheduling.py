@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import main
+
+BERLIN = ZoneInfo("Europe/Berlin")
+
+
+def utc(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+def slot(days, reminder_time, zone):
+    hours, minutes = map(int, reminder_time.split(":"))
+    return main.HabitSlot(main.days_mask(days), hours * 60 + minutes, zone)
+
+
+def test_reminder_in_the_spring_gap_fires_after_the_jump():
+    # 2026-03-29 в Берлине часы переводятся с 02:00 на 03:00: 02:30 не существует,
+    # напоминание приходит в 03:30 по летнему времени того же дня
+    every_day = slot(",".join(main.WEEKDAYS), "02:30", BERLIN)
+    assert main.next_fire_at(every_day, utc(2026, 3, 28, 23, 0)) == utc(2026, 3, 29, 1, 30)
+
+
+def test_reminder_in_the_autumn_fold_fires_once():
+    # 2026-10-25 02:30 в Берлине наступает дважды: срабатывает первое, повтор не ставится
+    every_day = slot(",".join(main.WEEKDAYS), "02:30", BERLIN)
+    first = main.next_fire_at(every_day, utc(2026, 10, 24, 23, 0))
+    assert first == utc(2026, 10, 25, 0, 30)
+    assert main.next_fire_at(every_day, first) == utc(2026, 10, 26, 1, 30)
+
+
+def test_weekday_is_taken_from_the_local_calendar():
+    # В Токио уже понедельник, а в UTC ещё воскресенье
+    monday = slot("Monday", "08:00", ZoneInfo("Asia/Tokyo"))
+    assert main.next_fire_at(monday, utc(2026, 10, 18, 22, 0)) == utc(2026, 10, 18, 23, 0)
+    # В Лос-Анджелесе ещё понедельник, а в UTC уже вторник
+    monday = slot("Monday", "20:00", ZoneInfo("America/Los_Angeles"))
+    assert main.next_fire_at(monday, utc(2026, 10, 20, 2, 0)) == utc(2026, 10, 20, 3, 0)
+
+
+def test_empty_days_mask_never_fires():
+    assert main.next_fire_at(slot("", "07:00", BERLIN), utc(2026, 10, 18, 0, 0)) is None
+
+
+def test_half_hour_zones():
+    kolkata = ZoneInfo("Asia/Kolkata")
+    assert main.next_fire_at(slot("Sunday", "09:00", kolkata), utc(2026, 10, 18, 0, 0)) == utc(2026, 10, 18, 3, 30)
+    assert main.utc_offset_hours(kolkata) == 5.5
+    assert main.utc_offset_hours(ZoneInfo("Asia/Kathmandu")) == 5.75
+    assert main.utc_offset_hours(timezone(timedelta(hours=-3))) == -3
+    # Фиксированное смещение без имени пояса тоже сохраняет получасовую часть
+    assert main.habit_zone(None, 5.5).utcoffset(None) == timedelta(hours=5, minutes=30)
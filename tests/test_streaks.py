@@ -0,0 +1,91 @@
+from datetime import date
+
+import main
+from conftest import FakeMessage
+
+MON_WED_FRI = main.days_mask("Monday,Wednesday,Friday")
+# 2024-01-01 — понедельник
+MONDAY = main.day_number(date(2024, 1, 1))
+
+
+def test_scheduled_days_continue_the_streak():
+    streak, last = 0, None
+    for day in (MONDAY, MONDAY + 2, MONDAY + 4, MONDAY + 7):
+        streak = main.next_streak(last, streak, day, "done", MON_WED_FRI)
+        last = day
+    assert streak == 4
+
+
+def test_missed_scheduled_day_breaks_the_streak():
+    # Среда пропущена: пятница начинает серию заново
+    assert main.next_streak(MONDAY, 3, MONDAY + 4, "done", MON_WED_FRI) == 1
+    assert main.next_streak(MONDAY, 3, MONDAY + 2, "missed", MON_WED_FRI) == 0
+
+
+def test_empty_schedule_counts_every_day():
+    assert main.next_streak(MONDAY, 2, MONDAY + 1, "done", 0) == 3
+    assert main.next_streak(MONDAY, 2, MONDAY + 2, "done", 0) == 1
+
+
+def test_streak_on_resets_after_a_missed_scheduled_day():
+    # Последний лог в пятницу: в понедельник серия ещё жива (сегодняшний день
+    # не закончился), во вторник после пропущенного понедельника — уже нет
+    friday = MONDAY + 4
+    assert main.streak_on(MONDAY + 7, MON_WED_FRI, friday, 5) == 5
+    assert main.streak_on(MONDAY + 8, MON_WED_FRI, friday, 5) == 0
+    assert main.streak_on(MONDAY + 7, MON_WED_FRI, None, 0) == 0
+
+
+def test_rebuild_counts_streaks_by_schedule(run):
+    async def scenario():
+        habit_id = await main.db.transaction(main.create_habit, 950, "health", "Gym", "d", "g",
+                                             "Monday,Wednesday,Friday", 0, "07:00")
+
+        def seed(conn):
+            # Шесть выполненных дней расписания подряд, затем пропуск среды и пятница
+            days = [MONDAY, MONDAY + 2, MONDAY + 4, MONDAY + 7, MONDAY + 9, MONDAY + 11, MONDAY + 18]
+            conn.executemany("INSERT INTO habit_logs (habit_id, day, user_id, status) VALUES (?, ?, 950, 'done')",
+                             [(habit_id, day) for day in days])
+            main.rebuild_habit_progress(conn, [habit_id])
+
+        await main.db.transaction(seed)
+        row = await main.db.fetchone(
+            "SELECT current_streak, longest_streak FROM habit_progress WHERE habit_id = ?", (habit_id,)
+        )
+        await main.db.transaction(main.delete_habit, 950, habit_id)
+        return row
+
+    assert run(scenario()) == (1, 6)
+
+
+def test_insert_habit_log_follows_the_schedule(run):
+    async def scenario():
+        habit_id = await main.db.transaction(main.create_habit, 951, "health", "Gym", "d", "g",
+                                             "Monday,Wednesday,Friday", 0, "07:00")
+        for day in (MONDAY, MONDAY + 2, MONDAY + 4):
+            await main.db.transaction(main.insert_habit_log, 951, habit_id, day, "done")
+        row = await main.db.fetchone(
+            "SELECT current_streak, longest_streak FROM habit_progress WHERE habit_id = ?", (habit_id,)
+        )
+        await main.db.transaction(main.delete_habit, 951, habit_id)
+        return row
+
+    assert run(scenario()) == (3, 3)
+
+
+def test_progress_screen_hides_a_broken_streak(run):
+    async def scenario():
+        habit_id = await main.db.transaction(main.create_habit, 952, "health", "Run", "d", "g",
+                                             "Monday,Wednesday,Friday", 0, "07:00")
+        # Серия из десяти дней, закончившаяся месяц назад
+        today = main.day_number(main.datetime.now(main.UTC).date())
+        for day in range(today - 40, today - 30):
+            await main.db.transaction(main.insert_habit_log, 952, habit_id, day, "done")
+        message = FakeMessage(952)
+        await main.show_progress(message)
+        await main.db.transaction(main.delete_habit, 952, habit_id)
+        main.user_habits.invalidate(952)
+        return message.answers[0]
+
+    text = run(scenario())
+    assert "🔥 Streak: 0 (best: " in text
@@ -0,0 +1,97 @@
+import time
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiohttp import web
+
+import main
+from conftest import FakeMessage, completion_response, sse_response
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_together_chat_stream_yields_chunks_and_records_usage(run, llm_server):
+    async def handler(request, body):
+        assert body["stream"] is True
+        return await sse_response(request, ["Keep ", "going", "!"], usage={"prompt_tokens": 7, "completion_tokens": 3})
+
+    async def scenario():
+        async with llm_server(handler):
+            return await collect(main.together_chat_stream({"messages": []}))
+
+    prompt_before = main.LLM_TOKENS.values.get(("prompt",), 0)
+    assert run(scenario()) == ["Keep ", "going", "!"]
+    assert main.LLM_TOKENS.values[("prompt",)] == prompt_before + 7
+
+
+def test_together_chat_stream_raises_on_error_chunk(run, llm_server):
+    async def handler(request, body):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b'data: {"error": {"message": "model overloaded"}}\n\n')
+        return response
+
+    async def scenario():
+        async with llm_server(handler):
+            try:
+                await collect(main.together_chat_stream({"messages": []}))
+            except RuntimeError as e:
+                return str(e)
+
+    assert run(scenario()) == "model overloaded"
+
+
+def test_stream_to_message_throttles_edits(run, llm_server, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0.2)
+    words = [f"w{i} " for i in range(20)]
+
+    async def handler(request, body):
+        return await sse_response(request, words, delay=0.05)
+
+    async def scenario():
+        placeholder = FakeMessage()
+        async with llm_server(handler):
+            started = time.monotonic()
+            text = await main.stream_to_message(placeholder, main.together_chat_stream({"messages": []}))
+        return text, placeholder.edits, time.monotonic() - started
+
+    text, edits, elapsed = run(scenario())
+    assert text == "".join(words).strip()
+    assert edits[-1] == text
+    # Промежуточные правки не чаще STREAM_EDIT_INTERVAL, с курсором в конце
+    intermediate = edits[:-1]
+    assert 1 <= len(intermediate) <= elapsed / 0.2 + 1
+    assert all(edit.endswith(" ▌") for edit in intermediate)
+
+
+def test_ai_chat_falls_back_to_full_response_when_streaming_fails(run, llm_server, monkeypatch):
+    monkeypatch.setattr(main, "AI_STREAMING", True)
+    requests = []
+
+    async def handler(request, body):
+        requests.append(bool(body.get("stream")))
+        if body.get("stream"):
+            return web.json_response({"error": {"message": "unavailable"}}, status=503)
+        return completion_response("Full answer")
+
+    async def scenario():
+        habit_id = await main.db.transaction(main.create_habit, 901, "health", "Run", "Daily run", "5 km",
+                                             "Monday", 0, "07:00")
+        message = FakeMessage(901, "How do I keep going?")
+        storage = main.SQLiteStorage(main.db, 60, 0.01, 100)
+        state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=901, user_id=901))
+        async with llm_server(handler):
+            await main.handle_ai_chat(message, state)
+        memory = await main.chat_memory(state, habit_id).get_data()
+        await storage.close()
+        await main.db.transaction(main.delete_habit, 901, habit_id)
+        main.user_habits.invalidate(901)
+        return message, memory
+
+    message, memory = run(scenario())
+    assert message.answers == ["💬 Thinking..."]
+    assert message.edits == ["Full answer"]
+    assert requests == [True, False]
+    assert [role for role, *_ in memory["chat_history"]] == ["user", "assistant"]